@@ -1,27 +1,29 @@
 import sublime_plugin
 import sublime
 import subprocess
-import sys, os, time, traceback
+import sys, os, re, time, traceback, tempfile, signal, codecs
 
 import webbrowser
-from threading import Thread
-from queue import Queue
-
-from NimPlus.nimsuggest import Nimsuggest, SymbolDefinition
-from NimPlus.docdisplay import cpublish_string
+from threading import Lock
+from collections import OrderedDict
+
+from NimPlus.nimsuggest import NimsuggestPool, SymbolDefinition, suggestions_truncated
+from NimPlus.docdisplay import render_docstring
+from NimPlus.cache import LRUCache
+from NimPlus import worker
+from NimPlus import perf
+from NimPlus import library
+from NimPlus.project import find_nimble_root, find_project_root, has_project_root
+from NimPlus.symbols import symbol_index_of, save_symbol_indexes
+from NimPlus.diagnostics import Diagnostic, parse_check_message, diagnostics_of, view_diagnostics
+from NimPlus.diagnostics import project_diagnostics, project_diagnostics_of, stored_diagnostics, show_diagnostics
 
 isWindows = sys.platform == "win32"
 settings = sublime.load_settings('NimPlus.sublime-settings')
-suggestionEngine = None # Can be a nimsuggest instance if needed.
-
-def enqueue_output(out, queue):
-	for line in iter(out.readline, b''):
-		queue.put(line)
-		# print("NimPlus:",queue.qsize(),line)
-	out.close()
+suggestionPool = NimsuggestPool() # One nimsuggest instance per project.
 
 # Used for executable management
-def start(args,outputManager = False,cwd = None):
+def start(args,cwd = None,mergeStderr = False):
 	# print("NimPlus:","Running: "," ".join(args))
 	if not isWindows:
 		args = [" ".join(args)]
@@ -31,27 +33,177 @@ def start(args,outputManager = False,cwd = None):
 		cwd=cwd,
 		stdin=subprocess.PIPE,
 		stdout=subprocess.PIPE,
-		stderr=subprocess.PIPE,
-		shell=True, bufsize=1
+		stderr=subprocess.STDOUT if mergeStderr else subprocess.PIPE,
+		shell=True, bufsize=1,
+		# Own process group, so that kill_process also stops what the shell started.
+		start_new_session=not isWindows
 	)
-	q = None
-	q2 = None
-	if outputManager:
-		q = Queue()
-		q2 = Queue()
-		t = Thread(target=enqueue_output, args=(p.stdout, q))
-		t2 = Thread(target=enqueue_output, args=(p.stderr, q))
-		t.daemon = True
-		t2.daemon = True
-		t.start()
-		t2.start()
-	# todo: close t when p dies
-	return p,q,q2
+	return p
 
 def terminate(process):
 	process.stdin.close()
 	process.terminate()
 	process.wait(timeout=0.2)
+
+def kill_process(process):
+	try:
+		if isWindows:
+			process.kill()
+		else:
+			os.killpg(process.pid, signal.SIGKILL)
+	except OSError: # already dead
+		pass
+
+# Unsaved buffers are written to these files for nimsuggest.
+# view id -> (change count, path)
+dirty_files = {}
+
+def dirty_directory():
+	# Prefer a tmpfs, these files are rewritten while typing.
+	base = tempfile.gettempdir()
+	if os.path.isdir("/dev/shm"):
+		base = "/dev/shm"
+	d = os.path.join(base, "NimPlus-dirty")
+	if not isWindows:
+		d += "-" + str(os.getuid())
+	if not os.path.isdir(d):
+		os.makedirs(d)
+	return d
+
+def get_dirty_file(view):
+	"""
+	Write the content of the buffer to a file that nimsuggest can read.
+	The file is only rewritten when the buffer changed.
+	Returns None when the buffer is saved: nimsuggest can use the file itself.
+	"""
+	if not view.is_dirty():
+		return None
+	change_count = view.change_count()
+	entry = dirty_files.get(view.id())
+	if entry != None and entry[0] == change_count:
+		return entry[1]
+	if entry != None:
+		path = entry[1]
+	else:
+		path = os.path.join(dirty_directory(), str(view.id()) + "_" + os.path.basename(view.file_name()))
+	try:
+		with open(path, "w", encoding="utf-8", newline="") as f:
+			f.write(view.substr(sublime.Region(0, view.size())))
+	except OSError:
+		return None
+	dirty_files[view.id()] = (change_count, path)
+	return path
+
+def remove_dirty_file(view_id):
+	entry = dirty_files.pop(view_id, None)
+	if entry != None:
+		try:
+			os.remove(entry[1])
+		except OSError:
+			pass
+
+# (file, change count, identifier start) -> CompletionEntry
+completion_cache = LRUCache(64)
+
+class CompletionEntry:
+	def __init__(self, prefix, items, rows):
+		self.prefix = prefix
+		self.items = items
+		self.rows = rows # suggestions in the response of nimsuggest
+
+def fuzzy_match(prefix, name):
+	# Same rule as Sublime: the characters of the prefix appear in order.
+	name = name.lower()
+	i = 0
+	for c in prefix.lower():
+		i = name.find(c, i)
+		if i < 0:
+			return False
+		i += 1
+	return True
+
+def cached_completions(filepath, change_count, start, prefix):
+	"""
+	Return the completion items of a previous query at the same
+	identifier, or None if nimsuggest needs to be asked.
+	"""
+	entry = completion_cache.peek((filepath, change_count, start))
+	if entry != None:
+		completion_cache.recordHit()
+		return entry.items
+	# The user kept typing the same identifier: the previous results
+	# only need to be narrowed down. Every typed character is one change.
+	# A response cut by nimsuggest may miss what matches the longer prefix.
+	for key, entry in completion_cache.items():
+		if key[0] != filepath or key[2] != start:
+			continue
+		if suggestions_truncated(entry.rows):
+			continue
+		if not prefix.startswith(entry.prefix):
+			continue
+		if change_count - key[1] != len(prefix) - len(entry.prefix):
+			continue
+		items = [item for item in entry.items if fuzzy_match(prefix, item.trigger)]
+		completion_cache.put((filepath, change_count, start), CompletionEntry(prefix, items, entry.rows))
+		completion_cache.recordHit()
+		return items
+	completion_cache.recordMiss()
+	return None
+
+completion_kinds = {
+	"skMacro": sublime.KIND_FUNCTION,
+	"skProc": sublime.KIND_FUNCTION,
+	"skIterator": sublime.KIND_FUNCTION,
+	"skTemplate": sublime.KIND_FUNCTION,
+	"skFunc": sublime.KIND_FUNCTION,
+	"skMethod": sublime.KIND_FUNCTION,
+	"skConverter": sublime.KIND_FUNCTION,
+	"skConst": sublime.KIND_VARIABLE,
+	"skLet": sublime.KIND_VARIABLE,
+	"skVar": sublime.KIND_VARIABLE,
+	"skEnumField": sublime.KIND_VARIABLE,
+	"skField": sublime.KIND_VARIABLE,
+	"skParam": sublime.KIND_VARIABLE,
+	"skResult": sublime.KIND_VARIABLE,
+	"skForVar": sublime.KIND_VARIABLE,
+	"skType": sublime.KIND_TYPE
+}
+
+def completion_items(suggestions):
+	"""
+	Build the completion items shown by Sublime from the suggestions of a sug response.
+	Overloads complete to the same thing: only the first one (the best match
+	for nimsuggest) is kept, with the number of overloads.
+	"""
+	first = {} # name -> first suggestion with this name, in order
+	overloads = {}
+	for suggestion in suggestions:
+		name = suggestion.name
+		if name in overloads:
+			overloads[name] += 1
+		else:
+			first[name] = suggestion
+			overloads[name] = 1
+	kinds = completion_kinds
+	ambiguous = sublime.KIND_AMBIGUOUS
+	details = {} # docstring -> html, many symbols have the same (often none)
+	items = []
+	for name, suggestion in first.items():
+		annotation = suggestion.signature
+		if overloads[name] > 1:
+			annotation += " (+%d)" % (overloads[name] - 1)
+		docstring = suggestion.docstring
+		if docstring not in details:
+			details[docstring] = render_docstring(docstring, summary = True)
+		items.append(sublime.CompletionItem(
+			trigger = name, # trigger is empty.
+			annotation = annotation, # annotation (displayed on the right). We display the type.
+			completion = name, # completion (will be inserted)
+			details = details[docstring], # displayed at the bottom, we display the documentation of the item
+			kind = kinds.get(suggestion.kind, ambiguous) # icon on the left.
+		))
+	return items
+
 # sanitize html:
 def escape(html):
 	return html.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;').replace("'", '&#39;')
@@ -62,28 +214,275 @@ def escape(html):
 def plugin_loaded():
 	global settings
 	settings = sublime.load_settings('NimPlus.sublime-settings')
+	suggestionPool.maxSize = settings.get("nimplus.nimsuggest.pool_size", 3)
+	worker.executor.submit(library.library_definitions)
 
 def plugin_unloaded():
-	global suggestionEngine
-
 	# Clean up
-	if suggestionEngine != None:
+	suggestionPool.terminateAll()
+	if library.store != None:
+		library.store.save()
+	save_symbol_indexes()
+	for view_id in list(dirty_files.keys()):
+		remove_dirty_file(view_id)
+
+import_format = re.compile(r"^\s*(?:import|from|include)\s+([^#\n]+)", re.MULTILINE)
+
+def imported_modules(view):
+	# Good enough to pick between library symbols with the same name.
+	text = view.substr(sublime.Region(0, min(view.size(), 20000)))
+	modules = {"system"}
+	for match in import_format.finditer(text):
+		names = match.group(1).split(" import ")[0]
+		for name in re.split(r"[\s,\[\]]+", names):
+			module = name.split("/")[-1]
+			if len(module) > 0:
+				modules.add(module)
+	return modules
+
+def library_definition(view, word):
+	"""
+	Definition of the library symbol under the mouse from what previous
+	sessions learned, or None if it is unknown or ambiguous.
+	"""
+	if library.store == None:
+		return None
+	candidates = library.store.lookup(view.substr(word))
+	if len(candidates) > 1:
+		modules = imported_modules(view)
+		candidates = [c for c in candidates if c.fullname.split(".")[0] in modules]
+	return candidates[0] if len(candidates) == 1 else None
+
+def remember_library_definitions(definitions, root):
+	# Symbols of the project change too often to be kept.
+	outside = [d for d in definitions if not d.filename.startswith(root + os.sep)]
+	if len(outside) == 0:
+		return
+	store = library.library_definitions()
+	if store.add(outside) >= 500:
+		store.save()
+
+def prewarm(filepath):
+	# The first hover or completion of a file does not have to wait
+	# for nimsuggest to start and compile it.
+	limit = settings.get("nimplus.nimsuggest.prewarm", 2)
+	if limit <= 0:
+		return
+	if not (settings.get("nimplus.autocomplete") or settings.get("nimplus.hoverdescription")):
+		return
+	# Not for the library files opened by go to definition: their nimsuggest
+	# would push the one of the project out of the pool.
+	if not has_project_root(filepath):
+		return
+	suggestionPool.prewarm(filepath, limit)
+
+def render_definition(suggestion):
+	"""
+	HTML of the hover popup of a symbol.
+	"""
+	# Convert RST to HTML.
+	docstr = render_docstring(suggestion.docstring)
+
+	body = """
+		<body id="NimPlus">
+		<style>
+			h4{
+				background-color: color(var(--background) alpha(0.25));
+				margin: 0;
+				padding: 5px;
+			}
+			#NimPlus code{
+				font-family: "Consolas", monospace;
+			}
+			#NimPlus{
+				margin: 0;
+				padding: 0;
+			}
+			#NimPlus #desc_block{
+				padding: 5px;
+				font-family: "Roboto", "Lato", Arial, sans-serif;
+			}
+			#NimPlus p{
+				margin: 0 0 5px 0;
+			}
+			#NimPlus .code{
+				background-color: color(var(--background) alpha(0.25));
+				padding: 3px;
+				margin: 0 0 5px 0;
+			}
+		</style>
+		<h4>%s</h4>
+		<div id="desc_block">
+		<a href="%s,%s,%s">
+			%s(%s,%s)
+		</a>
+		<div>
+			%s
+		</div>
+		</div>
+		</body>
+	""" % (
+		escape(suggestion.symbolType),
+		suggestion.filename,suggestion.line,suggestion.col,
+		suggestion.filename,suggestion.line,suggestion.col,
+		docstr
+	)
+	return body
+
+# view id -> LRUCache of (word begin, word end, change count) -> (SymbolDefinition, popup html)
+definition_cache = {}
+# The cache of a view is dropped when it changes: its hits and misses are counted here.
+hover_counts = {"hits": 0, "misses": 0}
+
+# file path -> nim check process running for it
+check_processes = {}
+check_lock = Lock() # saves and the checks they started use check_processes
+
+def check_with_nim(view, filepath):
+	nim_args = settings.get("nimplus.nim.arguments")
+
+	nim_checking_command = ["nim","check"] + nim_args
+	if not isWindows:
+		nim_checking_command.append("\""+ filepath +"\"")
+	else:
+		nim_checking_command.append(filepath)
+
+	# A new save makes the running check useless.
+	check_process = start(nim_checking_command, mergeStderr = True)
+	with check_lock:
+		stale_process = check_processes.get(filepath)
+		check_processes[filepath] = check_process
+	if stale_process != None:
+		kill_process(stale_process)
+	store = project_diagnostics_of(find_project_root(filepath))
+	if worker.executor.submit(run_check, view, filepath, check_process, store) == None:
+		# Nobody would read its output.
+		with check_lock:
+			if check_processes.get(filepath) is check_process:
+				del check_processes[filepath]
+		kill_process(check_process)
 		try:
-			suggestionEngine.terminate()
-		except:
+			check_process.wait(timeout=1)
+		except subprocess.TimeoutExpired:
 			pass
-		suggestionEngine = None
+		check_process.stdout.close()
+		view.window().status_message("Too busy to check the file, save again later.")
+
+def check_with_nimsuggest(view, filepath):
+	"""
+	Use the chk command of the nimsuggest instance of the project: the
+	modules it already compiled are not compiled again.
+	Falls back to nim check if nimsuggest does not answer.
+	"""
+	check_start = time.time()
+	def on_check(messages):
+		if messages == None:
+			check_with_nim(view, filepath)
+			return
+		# The nim check of an earlier save that timed out is older than this.
+		with check_lock:
+			stale_process = check_processes.pop(filepath, None)
+		if stale_process != None:
+			kill_process(stale_process)
+		store = project_diagnostics_of(find_project_root(filepath))
+		show_diagnostics(store, store.set([
+			Diagnostic(filename, line, col, severity, message)
+			for filename, line, col, severity, message in messages
+		]))
+		perf.record("check.nimsuggest.total", time.time() - check_start)
+		view.window().status_message("Check completed.")
 
-maxErrorRegionCount = 0
-error_body_table = {}
+	suggestionPool.get(filepath).requestCheck(filepath, on_check, key = ("chk", filepath))
+
+def run_check(view, filepath, check_process, store):
+	"""
+	Read the output of nim check while it runs and draw the
+	messages as they come, a few at a time. The messages about all
+	the files of the project are kept in store.
+	Stops as soon as a newer check of the same file replaces this one.
+	"""
+	def is_current():
+		with check_lock:
+			return check_processes.get(filepath) is check_process
+
+	waiting = [] # messages not drawn yet
+	cleared = False
+	check_start = time.time()
+	first_message = True
+	last_draw = time.time()
+	for raw in iter(check_process.stdout.readline, b''):
+		if not is_current():
+			break
+		message = parse_check_message(raw.decode("utf-8", "replace"))
+		if message != None:
+			waiting.append(message)
+			if first_message:
+				perf.record("check.nim.first_message", time.time() - check_start)
+				first_message = False
+		if len(waiting) > 0 and time.time() - last_draw > 0.2:
+			if not cleared:
+				show_diagnostics(store, store.set(waiting))
+				cleared = True
+			else:
+				show_diagnostics(store, store.add(waiting))
+			waiting = []
+			last_draw = time.time()
+	check_process.stdout.close()
+
+	with check_lock:
+		if check_processes.get(filepath) is not check_process:
+			return # cancelled
+		del check_processes[filepath]
+	if not cleared:
+		show_diagnostics(store, store.set(waiting) | set([filepath]))
+	elif len(waiting) > 0:
+		show_diagnostics(store, store.add(waiting))
+	try:
+		terminate(check_process)
+	except: # ProcessLookupError mostly.
+		pass
+	perf.record("check.nim.total", time.time() - check_start)
+	view.window().status_message("Check completed.")
 
 class NimPlusEvents(sublime_plugin.EventListener):
+	def on_close(self, view: sublime.View):
+		remove_dirty_file(view.id())
+		definition_cache.pop(view.id(), None)
+		view_diagnostics.pop(view.id(), None)
+
+	def on_load_async(self, view: sublime.View):
+		# Show what the last check found about this file.
+		filepath = view.file_name()
+		if type(filepath) == str and filepath.endswith(".nim"):
+			diagnostics = stored_diagnostics(filepath)
+			if len(diagnostics) > 0:
+				diagnostics_of(view).set(diagnostics)
+			# Without a project, the root is only the directory of the file:
+			# it is indexed when the user asks for it.
+			index = symbol_index_of(find_project_root(filepath))
+			if has_project_root(filepath) and index.startBuild():
+				if worker.executor.submit(index.build) == None:
+					index.cancelBuild()
+			prewarm(filepath)
+
+	def on_activated_async(self, view: sublime.View):
+		filepath = view.file_name()
+		if type(filepath) == str and filepath.endswith(".nim") and not view.is_loading():
+			prewarm(filepath)
+
+	def on_modified_async(self, view: sublime.View):
+		definition_cache.pop(view.id(), None)
+
 	def on_post_save_async(self,view: sublime.View):
-		global maxErrorRegionCount,settings
+		global settings
+		# Saving can change the definitions found in other files.
+		definition_cache.pop(view.id(), None)
+		filepath = view.file_name()
+		if type(filepath) == str and filepath.endswith(".nim"):
+			worker.executor.submit(update_symbols, filepath)
 		if not settings.get("nimplus.savecheck"):
 			return
 
-		filepath = view.file_name()
 		if type(filepath) != str or not view.match_selector(0, "source.nim"):
 			return
 		if filepath.endswith(".nimble"):
@@ -96,84 +495,14 @@ class NimPlusEvents(sublime_plugin.EventListener):
 		# run check process
 		view.window().status_message("Checking program validity ...")
 
-		nim_args = settings.get("nimplus.nim.arguments")
-
-		nim_checking_command = ["nim","check"] + nim_args
-		if not isWindows:
-			nim_checking_command.append("\""+ filepath +"\"")
+		if settings.get("nimplus.savecheck.mode") == "nimsuggest":
+			check_with_nimsuggest(view, filepath)
 		else:
-			nim_checking_command.append(filepath)
-
-		check_process = start(nim_checking_command)[0]
-		stdout,stderr = None,None
-		try:
-			stdout,stderr = check_process.communicate(timeout=8)
-		except:
-			view.window().status_message("Check failed. Timeout")
-			return
-
-		for i in range(maxErrorRegionCount+1):
-			regionId = "e" + str(i)
-			if regionId in error_body_table:
-				del error_body_table[regionId]
-			view.erase_regions(regionId)
-
-		lines = stdout.decode("utf-8").split("\n")
-		maxErrorRegionCount = 0
-
-		for check_message in lines:
-			if len(check_message) > 3 and check_message.startswith(filepath):
-				check_message = check_message[len(filepath):]
-				# (line, col) Verbosity: Decription [Code]
-				end = check_message.find(")")
-				position = check_message[check_message.find("(")+1:end]
-				line,col = position.split(",")
-				line = int(line)
-				col = int(col)
-
-				description = check_message[end+1:]
-				description = escape(description)
-				msg_type = description.split(":")[0]
-
-				pointStart = view.text_point(line-1,col-1)
-				# To compute point end,
-				# we need to find the token length as errors seem to
-				# always span exactly one token in Nim.
-				wordRegion = view.word(pointStart)
-
-				regionId = "e" + str(maxErrorRegionCount)
-				maxErrorRegionCount += 1
-
-				def on_close():
-					view.erase_regions(regionId)
-				def on_navigate():
-					pass
-
-				rcolor = "#f00" if msg_type.strip() == "Error" else "#00f"
-				regcolor = "region.redish" if msg_type.strip() == "Error" else "region.cyanish"
-
-				region_draw_flag = sublime.DRAW_SQUIGGLY_UNDERLINE + sublime.DRAW_NO_FILL + sublime.DRAW_NO_OUTLINE
-				error_body_table[regionId] = description
-
-				view.add_regions(
-					key=regionId,
-					regions=[wordRegion],
-					scope=regcolor,
-					icon="panel_close", # a 'x' icon
-					flags=region_draw_flag,
-				#	annotations=[description], # HTML format
-					annotation_color=rcolor,
-					on_navigate=on_navigate,
-					on_close=on_close) # left border
-			try:
-				terminate(check_process)
-			except: # ProcessLookupError mostly.
-				pass
-		view.window().status_message("Check completed.")
+			check_with_nim(view, filepath)
 
 	def on_hover(self, view: sublime.View, point, hover_zone):
 		# Show documentation and handle the "GOTO definition"
-		global settings, suggestionEngine
+		global settings
 		if not settings.get("nimplus.hoverdescription"):
 			return
 		filepath = view.file_name()
@@ -181,6 +510,9 @@ class NimPlusEvents(sublime_plugin.EventListener):
 			return
 
 		def on_navigate(href):
+			if href.startswith("http"): # link of the documentation
+				webbrowser.open(href)
+				return
 			file,line,col = href.split(",")
 			affected_view = view
 			if file != filepath:
@@ -195,86 +527,29 @@ class NimPlusEvents(sublime_plugin.EventListener):
 				aview.show(aview.text_point(line,col),True,False,False)
 
 			# Do this on another thread:
-			t = Thread(target=navigator, args=(affected_view, line,col))
-			t.daemon = True # thread dies with the program
-			t.start()
+			worker.executor.submit(navigator, affected_view, line, col)
 		def on_hide():
 			pass
 
 		popup_flags = sublime.HIDE_ON_MOUSE_MOVE_AWAY
 
-		for i in range(maxErrorRegionCount+1):
-			regionId = "e" + str(i)
-			regions = view.get_regions(regionId)
-			if len(regions) == 0: break
-			r = regions[0]
-			if r.contains(point):
-				errText = "Error"
-				if regionId in error_body_table:
-					errText = error_body_table[regionId]
-				view.show_popup(
-					content=errText,
-					flags=popup_flags,
-					location=point,
-					max_width=600,
-					max_height=150,
-					on_navigate=on_navigate,
-					on_hide=on_hide
-				)
-				return
-
-		if suggestionEngine == None:
-			suggestionEngine = Nimsuggest(filepath)
-		suggestionEngine.tryRestart()
-
 		# Check if the mouse is over an error.
 		# In that case, show the error.
-
-		def on_result(suggestion: SymbolDefinition):
-			if suggestion == None:
-				return
-			docstr = suggestion.docstring.replace("\\x0A","\n")[1:-1]
-			docstr = escape(docstr)
-			docstr = cpublish_string(docstr)
-			# Convert RST to HTML.
-			
-			body = """
-				<body id="NimPlus">
-				<style>
-					h4{
-						background-color: color(var(--background) alpha(0.25));
-						margin: 0;
-						padding: 5px;
-					}
-					#NimPlus code{
-						font-family: "Consolas", monospace;
-					}
-					#NimPlus{
-						margin: 0;
-						padding: 0;
-					}
-					#NimPlus #desc_block{
-						padding: 5px;
-						font-family: "Roboto", "Lato", Arial, sans-serif;
-					}
-				</style>
-				<h4>%s</h4>
-				<div id="desc_block">
-				<a href="%s,%s,%s">
-					%s(%s,%s)
-				</a>
-				<div>
-					%s
-				</div>
-				</div>
-				</body>
-			""" % (
-				escape(suggestion.symbolType),
-				suggestion.filename,suggestion.line,suggestion.col,
-				suggestion.filename,suggestion.line,suggestion.col,
-				docstr
+		diagnostics = view_diagnostics.get(view.id())
+		errText = diagnostics.messageAt(point) if diagnostics != None else None
+		if errText != None:
+			view.show_popup(
+				content=errText,
+				flags=popup_flags,
+				location=point,
+				max_width=600,
+				max_height=150,
+				on_navigate=on_navigate,
+				on_hide=on_hide
 			)
+			return
 
+		def show_definition(body):
 			view.show_popup(
 				content=body,
 				flags=popup_flags,
@@ -284,13 +559,55 @@ class NimPlusEvents(sublime_plugin.EventListener):
 				on_navigate=on_navigate,
 				on_hide=on_hide
 			)
-		
+
+		# Hovering again over the same symbol: no need to ask nimsuggest.
+		hover_start = time.time()
+		word = view.word(point)
+		cache_key = (word.begin(), word.end(), view.change_count())
+		cache = definition_cache.get(view.id())
+		if cache == None:
+			cache = LRUCache(32)
+			definition_cache[view.id()] = cache
+		cached = cache.peek(cache_key)
+		if cached != None:
+			hover_counts["hits"] += 1
+			show_definition(cached[1])
+			perf.record("hover.cached", time.time() - hover_start)
+			return
+		hover_counts["misses"] += 1
+
+		suggestionEngine = suggestionPool.get(filepath)
+		root = suggestionEngine.projectPath
+		if not suggestionEngine.ready:
+			# nimsuggest is still compiling the project: what previous
+			# sessions learned about the libraries is better than nothing.
+			definition = library_definition(view, word)
+			if definition != None:
+				show_definition(render_definition(definition))
+				perf.record("hover.library", time.time() - hover_start)
+				return
+
+		def on_result(suggestion: SymbolDefinition):
+			if suggestion == None:
+				return
+			worker.executor.submit(remember_library_definitions, [suggestion], root)
+			render_start = time.time()
+			body = render_definition(suggestion)
+			cache.put(cache_key, (suggestion, body))
+			show_definition(body)
+			perf.record("hover.ui_apply", time.time() - render_start)
+			perf.record("hover.total", time.time() - hover_start)
+
 		line,col = view.rowcol(point)
-		suggestionEngine.requestDefinition(filepath, line, col, on_result)
+		suggestionEngine.requestDefinition(
+			filepath, line, col, on_result, get_dirty_file(view),
+			key = ("def", view.id()),
+			isStale = lambda: view.change_count() != cache_key[2]
+		)
 
 
 	def on_query_completions(self, view, prefix, locations):
-		global settings, suggestionEngine
+		global settings
 		
 		if not settings.get("nimplus.autocomplete"):
 			return
@@ -301,9 +618,15 @@ class NimPlusEvents(sublime_plugin.EventListener):
 		if type(filepath) != str or not view.match_selector(locations[0], "source.nim"):
 			return
 
-		if suggestionEngine == None:
-			suggestionEngine = Nimsuggest(filepath)
-		suggestionEngine.tryRestart()
+		completion_start = time.time()
+		change_count = view.change_count()
+		start = locations[0] - len(prefix)
+		items = cached_completions(filepath, change_count, start, prefix)
+		if items != None:
+			perf.record("completion.cached", time.time() - completion_start)
+			return sublime.CompletionList(items, sublime.INHIBIT_WORD_COMPLETIONS)
+
+		suggestionEngine = suggestionPool.get(filepath)
 		
 		line,col = view.rowcol(locations[0])
 		# Needed for async completion instead of regular []
@@ -311,49 +634,108 @@ class NimPlusEvents(sublime_plugin.EventListener):
 
 		# Fetch the suggestions async.
 		def fillCompletions(suggestions):
-			global ready
-			# We need to save the file for nimsuggest to work properly here.
-			# view.run_command("save")
-			completions = []
-			
-			for i in suggestions:
-				# i[1] = skMacro, skProc, skType, skIterator, skTemplate, skFunc
-				#        skEnumField, skConst, skVar, skLet
-				kind = sublime.KIND_AMBIGUOUS
-				if i[1] in ["skMacro","skProc","skIterator","skTemplate","skFunc"]:
-					kind = sublime.KIND_FUNCTION
-				elif i[1] in ["skConst","skLet","skVar","skEnumField","skField"]:
-					kind = sublime.KIND_VARIABLE
-				elif i[1] in ["skType"]:
-					kind = sublime.KIND_TYPE
-				toComplete = i[2].split(".")
-				toComplete = toComplete[-1] # Remove the package prefix.
-
-				docstr = i[7].replace("\\x0A","\n")[1:-1]
-				# source = """http:open_recent_file""" #  {"file": "%s"} % i[4] # + "," + i[5] + "," + i[6]
-				# sourcelink = "<a href='%s'>Source</a> " % source
-				if len(docstr) >= 90:
-					docstr = docstr[:90] # maxlen: 60 chars to avoid having a big completion window.
-
-				details = "<div>%s</div>" % escape(docstr)
-
-				item = sublime.CompletionItem(
-					trigger = toComplete, # trigger is empty.
-					annotation = i[3], # annotation (displayed on the right). We display the type.
-					completion = toComplete, # completion (will be inserted)
-					details = details, # displayed at the bottom, we display the documentation of the item
-					kind = kind # icon on the left.
-				)
-				completions.append(item)
-			
-			lst.set_completions(completions, sublime.INHIBIT_WORD_COMPLETIONS)
+			build_start = time.time()
+			worker.executor.submit(remember_library_definitions, suggestions, suggestionEngine.projectPath)
+			completions = completion_items(suggestions)
 
-		suggestionEngine.requestSuggestion(filepath, line, col, fillCompletions)
+			if len(completions) > 0:
+				completion_cache.put((filepath, change_count, start), CompletionEntry(prefix, completions, len(suggestions)))
+			lst.set_completions(completions, sublime.INHIBIT_WORD_COMPLETIONS)
+			perf.record("completion.ui_apply", time.time() - build_start)
+			perf.record("completion.total", time.time() - completion_start)
+
+		suggestionEngine.requestSuggestion(
+			filepath, line, col, fillCompletions, get_dirty_file(view),
+			key = ("sug", view.id()),
+			isStale = lambda: view.change_count() != change_count
+		)
 		
 		return lst
 
 proc = None
 
+class OutputPanelWriter:
+	"""
+	Streams the output of a process into an output panel.
+	The text is appended in batches, at most one append every 50 ms, so that
+	a program printing a lot does not flood Sublime with commands.
+	When the panel gets too big, the oldest text is removed.
+	ansi: convert the ANSI color codes of the output.
+	"""
+	def __init__(self, panel, ansi = True):
+		self.panel = panel
+		self.ansi = ansi
+		self.lock = Lock()
+		self.buffer = []
+		self.scheduled = False
+		self.maxSize = settings.get("nimplus.output.max_size", 1000000)
+		self.ansiPending = False
+		self.lastAnsi = 0
+
+	def write(self, text):
+		# Called by the reader, the panel is updated later on the main thread.
+		with self.lock:
+			self.buffer.append(text)
+			if self.scheduled:
+				return
+			self.scheduled = True
+		sublime.set_timeout(self.flush, 50)
+
+	def close(self):
+		sublime.set_timeout(lambda: self.flush(True), 50)
+
+	def flush(self, final = False):
+		with self.lock:
+			text = "".join(self.buffer)
+			self.buffer = []
+			self.scheduled = False
+		if len(text) > self.maxSize:
+			text = text[-self.maxSize:]
+		if len(text) > 0:
+			# force: the panel is read only once the ANSI colors are applied.
+			self.panel.run_command("append", {"characters": text, "force": True, "scroll_to_end": True})
+			overflow = self.panel.size() - self.maxSize
+			if overflow > 0:
+				self.panel.run_command("trim_output_nim", {"size": overflow})
+			if "\x1b" in text:
+				self.ansiPending = True
+		if not self.ansi:
+			return
+		# The ANSI pass only finds the codes that were not converted yet,
+		# running it once in a while colors the new text only.
+		if final or (self.ansiPending and time.time() - self.lastAnsi > 1.0):
+			self.panel.run_command("ansi", args={"clear_before": False})
+			self.ansiPending = False
+			self.lastAnsi = time.time()
+
+def stream_output(process, writer):
+	decoder = codecs.getincrementaldecoder("utf-8")("replace")
+	while True:
+		chunk = process.stdout.read1(65536) # whatever is available, blocks if nothing.
+		if len(chunk) == 0:
+			break
+		writer.write(decoder.decode(chunk))
+	writer.write(decoder.decode(b"", True))
+	process.stdout.close()
+	writer.close()
+
+def run_in_output_panel(window, com, cwd = None):
+	global proc
+	proc = start(com, cwd = cwd, mergeStderr = True)
+	window.destroy_output_panel("compilation")
+	new_view = window.create_output_panel("compilation",False)
+	window.run_command("show_panel", {"panel": "output.compilation"})
+	worker.executor.submit(stream_output, proc, OutputPanelWriter(new_view))
+
+class TrimOutputNimCommand(sublime_plugin.TextCommand):
+	def run(self, edit, size):
+		# Remove whole lines from the start of the panel.
+		end = min(self.view.line(size).end() + 1, self.view.size())
+		read_only = self.view.is_read_only()
+		self.view.set_read_only(False)
+		self.view.erase(edit, sublime.Region(0, end))
+		self.view.set_read_only(read_only)
+
 def run_in_terminus(window,commands,cwd):
 	str_com = ""
 	for argument in commands:
@@ -384,7 +766,7 @@ def execute_nim_command_on_file(commands,comobj):
 	if type(filepath) != str or not view.match_selector(point, "source.nim"):
 		return
 	if proc != None and proc.poll() is None: # kill the running process.
-		proc.terminate()
+		kill_process(proc)
 
 	com = commands
 
@@ -401,23 +783,8 @@ def execute_nim_command_on_file(commands,comobj):
 	else:
 		com.append(filepath)
 
-	proc,stdout,stderr = start(com,True)
-	comobj.window.destroy_output_panel("compilation")
-	new_view = comobj.window.create_output_panel("compilation",False)
-	comobj.window.run_command("show_panel", {"panel": "output.compilation"})
-
-	def async_fill():
-		while proc.poll() is None:
-			time.sleep(0.01)
-			while not stdout.empty():
-				l = stdout.get(block=False)
-				l = l.decode("utf-8")
-				new_view.run_command("append", {"characters": l})
-		# Apply the ANSI theme at the end because it's readonly.
-		new_view.run_command("ansi", args={"clear_before": True})
-	t = Thread(target=async_fill)
-	t.daemon = True
-	t.start()
+	run_in_output_panel(comobj.window, com)
+
 def execute_nim_command_on_project(commands,comobj,noFilename = False):
 	# commands is an array like ["nim","doc"] for example.
 	global proc
@@ -431,26 +798,11 @@ def execute_nim_command_on_project(commands,comobj,noFilename = False):
 	if type(filepath) != str or not view.match_selector(point, "source.nim"):
 		return
 	if proc != None and proc.poll() is None: # kill the running process.
-		proc.terminate()
-
-	p = os.path.abspath(filepath)
-	found = False
-	for i in range(100):
-		if p == os.path.dirname(p):
-			break
-		if not os.path.isdir(p):
-			p = os.path.dirname(p)
-			continue
-		files = [x for x in os.listdir(p) if (x.endswith(".nimble") and os.path.isfile(os.path.join(p,x)))]
-		if len(files) <= 0:
-			p = os.path.dirname(p)
-			continue
-		else:
-			found = True
-			break
+		kill_process(proc)
 
 	# move up the filepath until we find a .nimble file. 
-	if not found:
+	p = find_nimble_root(filepath)
+	if p == None:
 		comobj.window.destroy_output_panel("compilation")
 		new_view = comobj.window.create_output_panel("compilation",False)
 		comobj.window.run_command("show_panel", {"panel": "output.compilation"})
@@ -468,27 +820,7 @@ def execute_nim_command_on_project(commands,comobj,noFilename = False):
 		run_in_terminus(comobj.window,com,p)
 		return
 
-	proc,stdout,stderr = start(com,True,cwd = str(p))
-	comobj.window.destroy_output_panel("compilation")
-	new_view = comobj.window.create_output_panel("compilation",False)
-	comobj.window.run_command("show_panel", {"panel": "output.compilation"})
-	
-	def async_fill():
-		while proc.poll() is None:
-			time.sleep(0.01)
-			while not stderr.empty():
-				l = stderr.get(block=False)
-				l = l.decode("utf-8")
-				new_view.run_command("append",{"characters":l})
-			while not stdout.empty():
-				l = stdout.get(block=False)
-				l = l.decode("utf-8")
-				new_view.run_command("append", {"characters": l})
-		# Apply the ANSI theme at the end because it's readonly.
-		new_view.run_command("ansi", args={"clear_before": True})
-	t = Thread(target=async_fill)
-	t.daemon = True
-	t.start()
+	run_in_output_panel(comobj.window, com, cwd = str(p))
 
 class CompileNimCommand(sublime_plugin.WindowCommand):
 	def run(self, **kwargs):
@@ -568,30 +900,280 @@ class OpenDocumentNimCommand(sublime_plugin.WindowCommand):
 	def run(self):
 		view = self.window.active_view()
 		filepath = view.file_name()
-		p = os.path.abspath(filepath)
-		found = False
-		for i in range(100):
-			if os.path.dirname(p) == p:
-				break
-			if not os.path.isdir(p):
-				p = os.path.dirname(p)
-				continue
-			files = [x for x in os.listdir(p) if (x.endswith(".nimble") and os.path.isfile(os.path.join(p,x)))]
-			if len(files) <= 0:
-				p = os.path.dirname(p)
-				continue
-			else:
-				found = True
-				break
-
 		# move up the filepath until we find a .nimble file. 
-		if not found:
+		p = find_nimble_root(filepath)
+		if p == None:
 			sublime.message_dialog("Documentation not found.")
+			return
 
 		p = os.path.join(p,"htmldocs/theindex.html")
 		webbrowser.open_new_tab("file:///" + p)
 
 
+class ShowDiagnosticsNimCommand(sublime_plugin.WindowCommand):
+	def run(self):
+		# Diagnostics of the project of the current file, or of every project.
+		stores = list(project_diagnostics.values())
+		view = self.window.active_view()
+		if view != None and type(view.file_name()) == str:
+			root = find_project_root(view.file_name())
+			if root in project_diagnostics:
+				stores = [project_diagnostics[root]]
+
+		diagnostics = [d for store in stores for d in store.all()]
+		if len(diagnostics) == 0:
+			self.window.status_message("No errors found by the last check.")
+			return
+
+		items = [
+			[d.severity + ": " + d.message, "%s:%d:%d" % (d.filename, d.line, d.col)]
+			for d in diagnostics
+		]
+		def on_select(index):
+			if index < 0:
+				return
+			d = diagnostics[index]
+			self.window.open_file("%s:%d:%d" % (d.filename, d.line, d.col), sublime.ENCODED_POSITION)
+		self.window.show_quick_panel(items, on_select)
+
+def update_symbols(filepath):
+	index = symbol_index_of(find_project_root(filepath))
+	if index.loaded:
+		if index.updateFile(filepath):
+			index.saveLater()
+	elif has_project_root(filepath) and index.startBuild():
+		index.build()
+
+class GotoSymbolNimCommand(sublime_plugin.WindowCommand):
+	def run(self):
+		view = self.window.active_view()
+		if view != None and type(view.file_name()) == str:
+			root = find_project_root(view.file_name())
+		elif len(self.window.folders()) > 0:
+			root = self.window.folders()[0]
+		else:
+			self.window.status_message("Open a Nim file or a folder to search its symbols.")
+			return
+		index = symbol_index_of(root)
+		if index.loaded:
+			self.show(index)
+			return
+		# First time for this project: the files need to be scanned.
+		self.window.status_message("Indexing the symbols of %s ..." % os.path.basename(root))
+		def build():
+			if index.startBuild():
+				index.build()
+			else: # already started, when a file of the project was opened
+				index.built.wait(60)
+			sublime.set_timeout(lambda: self.show(index), 0)
+		worker.executor.submit(build)
+
+	def show(self, index):
+		symbols = index.all()
+		if len(symbols) == 0:
+			self.window.status_message("No symbols found in " + index.root)
+			return
+		items = [
+			[name, "%s  %s:%d" % (kind, os.path.relpath(filename, index.root), line)]
+			for name, kind, filename, line, col in symbols
+		]
+		def on_select(selected):
+			if selected < 0:
+				return
+			name, kind, filename, line, col = symbols[selected]
+			self.window.open_file("%s:%d:%d" % (filename, line, col), sublime.ENCODED_POSITION)
+		self.window.show_quick_panel(items, on_select)
+
+class FindUsagesNimCommand(sublime_plugin.TextCommand):
+	def run(self, edit):
+		filepath = self.view.file_name()
+		if type(filepath) != str:
+			return
+		window = self.view.window()
+		line, col = self.view.rowcol(self.view.sel()[0].begin())
+		limit = settings.get("nimplus.usages.max_results", 1000)
+
+		panel = window.create_output_panel("nimplus_usages")
+		panel.settings().set("result_file_regex", r"^(.+):(\d+):(\d+)")
+		window.run_command("show_panel", {"panel": "output.nimplus_usages"})
+		# The places are shown as nimsuggest finds them.
+		writer = OutputPanelWriter(panel, ansi = False)
+		writer.write("Usages of %s\n\n" % self.view.substr(self.view.word(self.view.sel()[0])))
+
+		def on_usage(usage):
+			writer.write("%s:%d:%d  %s\n" % (usage.filename, usage.line, usage.col + 1, usage.fullname))
+		def on_done(count):
+			if count == None:
+				writer.write("nimsuggest did not answer.\n")
+			elif count > limit:
+				writer.write("\n%d usages, only the first %d are listed.\n" % (count, limit))
+			else:
+				writer.write("\n%d usages.\n" % count)
+			writer.close()
+		suggestionPool.get(filepath).listUsages(filepath, line, col, on_usage, on_done, get_dirty_file(self.view), limit)
+
+identifier_format = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+def same_identifier(a, b):
+	# Nim identifiers are equal if the first letter is the same, the
+	# rest is compared ignoring the case and the underscores.
+	return a[:1] == b[:1] and a[1:].replace("_", "").lower() == b[1:].replace("_", "").lower()
+
+def identifier_spans(text, cols, name):
+	"""
+	(start, end) of the identifiers of a line starting at the given columns
+	that are the same identifier as name, from the last one to the first one.
+	Positions where something else is written are skipped.
+	"""
+	spans = []
+	for col in sorted(set(cols), reverse=True):
+		match = identifier_format.match(text, col)
+		if match != None and match.start() == col and same_identifier(match.group(0), name):
+			spans.append((match.start(), match.end()))
+	return spans
+
+def rename_in_file(filename, places, oldName, newName):
+	# Files that are not open: one read and one write per file.
+	# Returns False if the file could not be changed.
+	try:
+		with open(filename, encoding="utf-8", newline="") as f:
+			lines = f.read().splitlines(True)
+	except OSError as err:
+		print("NimPlus:", "could not rename in", filename, err)
+		return False
+	cols = {}
+	for line, col, text in places:
+		cols.setdefault(line - 1, []).append(col)
+	changed = False
+	for number, columns in cols.items():
+		if number >= len(lines):
+			continue
+		text = lines[number]
+		for start, end in identifier_spans(text, columns, oldName):
+			text = text[:start] + newName + text[end:]
+			changed = True
+		lines[number] = text
+	if changed:
+		try:
+			with open(filename, "w", encoding="utf-8", newline="") as f:
+				f.write("".join(lines))
+		except OSError as err:
+			print("NimPlus:", "could not rename in", filename, err)
+			return False
+	return True
+
+def apply_rename(window, result, newName):
+	if result == None:
+		window.status_message("nimsuggest did not answer, nothing renamed.")
+		return
+	oldName, edits = result
+	if oldName == None or identifier_format.fullmatch(oldName) == None:
+		window.status_message("No symbol to rename here.")
+		return
+	closed = []
+	for filename, places in edits.items():
+		view = None
+		for w in sublime.windows():
+			view = w.find_open_file(filename)
+			if view != None:
+				break
+		if view != None: # the buffer may have unsaved changes.
+			view.run_command("rename_identifiers_nim", {
+				"places": [[line, col] for line, col, text in places],
+				"old_name": oldName,
+				"new_name": newName
+			})
+		else:
+			closed.append((filename, places))
+	def rename_closed_files():
+		failed = [filename for filename, places in closed if not rename_in_file(filename, places, oldName, newName)]
+		message = "Renamed %s to %s in %d files." % (oldName, newName, len(edits) - len(failed))
+		if len(failed) > 0:
+			message += " Could not write %d files, see the console." % len(failed)
+		sublime.set_timeout(lambda: window.status_message(message), 0)
+	if worker.executor.submit(rename_closed_files) == None:
+		window.status_message("Too busy to rename in the files that are not open, try again.")
+
+class RenameIdentifiersNimCommand(sublime_plugin.TextCommand):
+	def run(self, edit, places, old_name, new_name):
+		lines = {}
+		for line, col in places:
+			lines.setdefault(line - 1, []).append(col)
+		regions = []
+		for number, cols in lines.items():
+			start = self.view.text_point(number, 0)
+			text = self.view.substr(self.view.line(start))
+			regions.extend(sublime.Region(start + a, start + b) for a, b in identifier_spans(text, cols, old_name))
+		# From the end, so that the positions before are still valid.
+		for region in sorted(regions, key=lambda r: r.begin(), reverse=True):
+			self.view.replace(edit, region, new_name)
+
+class NewNameInputHandler(sublime_plugin.TextInputHandler):
+	def __init__(self, initial):
+		self.initial = initial
+	def name(self):
+		return "new_name"
+	def placeholder(self):
+		return "New name"
+	def initial_text(self):
+		return self.initial
+	def validate(self, text):
+		return identifier_format.fullmatch(text) != None
+
+class RenameSymbolNimCommand(sublime_plugin.TextCommand):
+	def run(self, edit, new_name):
+		filepath = self.view.file_name()
+		if type(filepath) != str:
+			return
+		window = self.view.window()
+		if identifier_format.fullmatch(new_name) == None:
+			window.status_message(new_name + " is not a valid identifier.")
+			return
+		line, col = self.view.rowcol(self.view.sel()[0].begin())
+		window.status_message("Looking for the usages ...")
+		def on_edits(result):
+			sublime.set_timeout(lambda: apply_rename(window, result, new_name), 0)
+		suggestionPool.get(filepath).renameSymbol(filepath, line, col, new_name, on_edits, get_dirty_file(self.view))
+
+	def input(self, args):
+		if "new_name" not in args:
+			return NewNameInputHandler(self.view.substr(self.view.word(self.view.sel()[0])))
+
+def performance_counters():
+	return OrderedDict([
+		("completion cache", completion_cache.stats()),
+		("hover cache", OrderedDict([("hits", hover_counts["hits"]), ("misses", hover_counts["misses"])])),
+		("background tasks", worker.executor.stats()),
+		("nimsuggest", suggestionPool.stats())
+	])
+
+class ShowPerformanceNimCommand(sublime_plugin.WindowCommand):
+	def run(self, json = False):
+		view = self.window.new_file()
+		view.set_scratch(True)
+		if json:
+			view.set_name("NimPlus performance.json")
+			view.assign_syntax("Packages/JSON/JSON.sublime-syntax")
+			text = perf.export_json(performance_counters())
+		else:
+			view.set_name("NimPlus performance")
+			text = perf.format_report(performance_counters())
+		view.run_command("append", {"characters": text})
+
+class ShowNimsuggestLogNimCommand(sublime_plugin.WindowCommand):
+	def run(self):
+		view = self.window.new_file()
+		view.set_scratch(True)
+		view.set_name("nimsuggest log")
+		lines = []
+		for root, log in suggestionPool.logs().items():
+			lines.append("# " + root)
+			lines.extend(log)
+			lines.append("")
+		if len(lines) == 0:
+			lines.append("No nimsuggest running.")
+		view.run_command("append", {"characters": "\n".join(lines) + "\n"})
+
 class NimPlusOpenSiteCommand(sublime_plugin.WindowCommand):
 	def run(self, url):
 		webbrowser.open_new_tab(url)
@@ -0,0 +1,76 @@
+"""
+
+Stand-in for nimsuggest used by the benchmarks.
+It speaks the --stdin protocol and answers sug and def queries by replaying
+the responses recorded in the recorded directory, repeated to reach the
+wanted number of rows.
+
+"""
+
+import argparse
+import os
+import sys
+import time
+
+recorded_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "recorded")
+
+def load_rows(name):
+	with open(os.path.join(recorded_directory, name + ".txt"), encoding="utf-8") as f:
+		return [line.rstrip("\n") for line in f if line.strip() != ""]
+
+def replay(rows, count):
+	"""
+	Repeat the recorded rows until count rows are produced.
+	The copies get a different name so that they are different symbols.
+	"""
+	result = []
+	for i in range(count):
+		data = rows[i % len(rows)].split("\t")
+		if i >= len(rows):
+			data[2] += str(i // len(rows))
+		result.append("\t".join(data))
+	return result
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--rows", type=int, default=1000, help="rows in a sug answer")
+	parser.add_argument("--delay", type=float, default=0, help="seconds before answering")
+	parser.add_argument("--rate", type=float, default=0, help="rows written per second, 0 for no limit")
+	parser.add_argument("--startup", type=float, default=0, help="seconds taken to 'compile' the project")
+	# The options of the real nimsuggest and the project file are ignored.
+	args, _ = parser.parse_known_args()
+
+	answers = {
+		"sug": replay(load_rows("sug"), args.rows),
+		"def": load_rows("def")
+	}
+
+	out = sys.stdout
+	out.write("Nimsuggest - fake version used by the NimPlus benchmarks\n\n")
+	out.flush()
+	time.sleep(args.startup)
+	while True:
+		out.write("> ")
+		out.flush()
+		query = sys.stdin.readline()
+		if not query:
+			break
+		command = query.split(" ", 1)[0].strip()
+		if command == "quit":
+			break
+		time.sleep(args.delay)
+		rows = answers.get(command, [])
+		if args.rate > 0:
+			# Write in small chunks to look like a slow process.
+			chunk = max(1, int(args.rate / 100))
+			for i in range(0, len(rows), chunk):
+				out.write("\n".join(rows[i:i+chunk]) + "\n")
+				out.flush()
+				time.sleep(chunk / args.rate)
+		elif len(rows) > 0:
+			out.write("\n".join(rows) + "\n")
+		out.write("\n")
+		out.flush()
+
+if __name__ == "__main__":
+	main()
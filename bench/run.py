@@ -0,0 +1,201 @@
+"""
+
+Benchmarks of NimPlus that run outside of Sublime Text, without Nim installed.
+The sublime module is replaced by the stub of this directory and nimsuggest
+by fake_nimsuggest.py, which replays recorded answers.
+
+	python bench/run.py                      # run everything
+	python bench/run.py --quick              # smaller sizes, a few seconds
+	python bench/run.py --save base.json     # keep the results
+	python bench/run.py --compare base.json  # fail when something got slower
+	python bench/run.py --startup 2          # time the start of nimsuggest too
+
+"""
+
+import argparse
+import json
+import os
+import shlex
+import sys
+import tempfile
+import time
+import types
+from collections import OrderedDict
+from threading import Event
+
+bench_directory = os.path.dirname(os.path.abspath(__file__))
+package_directory = os.path.dirname(bench_directory)
+
+# The plugin imports itself as the NimPlus package, whatever the name of
+# the directory it is in.
+sys.path.insert(0, bench_directory)
+package = types.ModuleType("NimPlus")
+package.__path__ = [package_directory]
+sys.modules["NimPlus"] = package
+
+import sublime
+sublime.settings.update({
+	"nimplus.nimsuggest.debounce_ms": 0,
+	"nimplus.nimsuggest.timeout": 60,
+	"nimplus.nimsuggest.startup_timeout": 60
+})
+
+from NimPlus import perf
+from NimPlus.nimsuggest import Nimsuggest, Suggestion, parse_suggestions, parse_definition, unescape_nim_string
+from NimPlus.docdisplay import cpublish_string
+from NimPlus.NimPlus import completion_items
+from NimPlus.docdisplay import rendered
+import fake_nimsuggest
+
+def recorded_rows(name, count):
+	return fake_nimsuggest.replay(fake_nimsuggest.load_rows(name), count)
+
+def measure(name, fn, repeat):
+	"""
+	Call fn repeat times and record each duration under name.
+	Returns the total time in seconds.
+	"""
+	total = 0
+	for i in range(repeat):
+		start = time.perf_counter()
+		fn()
+		elapsed = time.perf_counter() - start
+		perf.record(name, elapsed)
+		total += elapsed
+	return total
+
+def bench_parsing(sizes, repeat, throughput):
+	# parse_suggestions stops after max_suggestions rows: the throughput
+	# counts the rows really parsed, not the size of the answer.
+	for size in sizes:
+		lines = recorded_rows("sug", size)
+		parsed = len(parse_suggestions(lines))
+		total = measure("bench.parse_suggestions.%d" % size, lambda: parse_suggestions(lines), repeat)
+		throughput["parse_suggestions.%d" % size] = round(parsed * repeat / total)
+	lines = recorded_rows("def", 1)
+	measure("bench.parse_definition", lambda: parse_definition(lines), repeat * 10)
+
+def bench_completion_items(sizes, repeat, throughput):
+	for size in sizes:
+		suggestions = [Suggestion(line.split("\t")) for line in recorded_rows("sug", size)]
+		def cold():
+			rendered.clear()
+			completion_items(suggestions)
+		total = measure("bench.completion_items_cold.%d" % size, cold, repeat)
+		throughput["completion_items_cold.%d" % size] = round(size * repeat / total)
+		total = measure("bench.completion_items.%d" % size, lambda: completion_items(suggestions), repeat)
+		throughput["completion_items.%d" % size] = round(size * repeat / total)
+
+def check_unescape():
+	# nimsuggest escapes the bytes of utf-8 text one by one.
+	text = unescape_nim_string(fake_nimsuggest.load_rows("sug")[-1].split("\t")[7])
+	if "\u00e9cole" not in text or "\u00c9COLE" not in text:
+		raise RuntimeError("non-ASCII docstring decoded as %r" % text)
+
+def bench_cpublish_string(repeat, throughput):
+	docstrings = [
+		unescape_nim_string(line.split("\t")[7])
+		for line in fake_nimsuggest.load_rows("sug") + fake_nimsuggest.load_rows("def")
+	]
+	def publish_all():
+		for docstring in docstrings:
+			cpublish_string(docstring)
+	total = measure("bench.cpublish_string", publish_all, repeat)
+	throughput["cpublish_string"] = round(len(docstrings) * repeat / total)
+
+def start_fake_nimsuggest(project, rows, delay, rate, startup):
+	command = [sys.executable, os.path.join(bench_directory, "fake_nimsuggest.py"),
+		"--rows", str(rows), "--delay", str(delay), "--rate", str(rate), "--startup", str(startup)]
+	sublime.settings["nimplus.nimsuggest.path"] = " ".join(shlex.quote(arg) for arg in command)
+	instance = Nimsuggest(project)
+	deadline = time.time() + startup + 30
+	while not instance.ready:
+		if time.time() > deadline or not instance.gettingReady:
+			raise RuntimeError("fake nimsuggest did not start")
+		time.sleep(0.01)
+	return instance
+
+def bench_requests(sizes, repeat, throughput, delay, rate, startup):
+	project = os.path.join(tempfile.mkdtemp(prefix = "nimplus-bench-"), "main.nim")
+	with open(project, "w") as f:
+		f.write("echo 1\n")
+	for size in sizes:
+		instance = start_fake_nimsuggest(project, size, delay, rate, startup)
+		try:
+			total = 0
+			parsed = [] # the callback only gets the first max_suggestions rows
+			for i in range(repeat):
+				done = Event()
+				start = time.perf_counter()
+				instance.requestSuggestion(project, 0, 0, lambda suggestions: (parsed.append(len(suggestions)), done.set()))
+				if not done.wait(60):
+					raise RuntimeError("no answer from fake nimsuggest")
+				elapsed = time.perf_counter() - start
+				perf.record("bench.request_sug.%d" % size, elapsed)
+				total += elapsed
+			throughput["request_sug.%d" % size] = round(sum(parsed) / total)
+			for i in range(repeat):
+				done = Event()
+				start = time.perf_counter()
+				instance.requestDefinition(project, 0, 0, lambda definition: done.set())
+				if not done.wait(60):
+					raise RuntimeError("no answer from fake nimsuggest")
+				perf.record("bench.request_def", time.perf_counter() - start)
+		finally:
+			instance.terminate()
+
+def compare(results, baseline, tolerance):
+	"""
+	Returns the benchmarks whose median is slower than in the baseline.
+	"""
+	regressions = []
+	for name, summary in results["timings"].items():
+		before = baseline["timings"].get(name)
+		if not name.startswith("bench.") or before == None or before["p50"] <= 0:
+			continue
+		ratio = summary["p50"] / before["p50"]
+		if ratio > 1 + tolerance:
+			regressions.append((name, before["p50"], summary["p50"], ratio))
+	return regressions
+
+def main():
+	parser = argparse.ArgumentParser(description = "NimPlus benchmarks")
+	parser.add_argument("--quick", action = "store_true", help = "smaller sizes and fewer repetitions")
+	parser.add_argument("--delay", type = float, default = 0, help = "seconds the fake nimsuggest waits before answering")
+	parser.add_argument("--rate", type = float, default = 0, help = "rows per second written by the fake nimsuggest")
+	parser.add_argument("--startup", type = float, default = 0, help = "seconds the fake nimsuggest takes to be ready (see nimsuggest.spawn_to_ready)")
+	parser.add_argument("--save", help = "write the results to this json file")
+	parser.add_argument("--compare", help = "json file of a previous run to compare with")
+	parser.add_argument("--tolerance", type = float, default = 0.25, help = "allowed slowdown of the median, 0.25 is 25%%")
+	args = parser.parse_args()
+
+	sizes = [1000, 10000] if args.quick else [1000, 10000, 100000]
+	repeat = 5 if args.quick else 20
+
+	check_unescape()
+
+	throughput = OrderedDict() # rows (or docstrings) per second
+	bench_parsing(sizes, repeat, throughput)
+	bench_completion_items(sizes, repeat, throughput)
+	bench_cpublish_string(repeat * 10, throughput)
+	bench_requests(sizes, repeat, throughput, args.delay, args.rate, args.startup)
+
+	extra = OrderedDict([("throughput (per second)", throughput)])
+	print(perf.format_report(extra))
+	results = json.loads(perf.export_json(extra))
+
+	if args.save:
+		with open(args.save, "w") as f:
+			json.dump(results, f, indent = 4)
+	if args.compare:
+		with open(args.compare) as f:
+			baseline = json.load(f)
+		regressions = compare(results, baseline, args.tolerance)
+		for name, before, after, ratio in regressions:
+			print("slower: %s %.2fms -> %.2fms (x%.2f)" % (name, before, after, ratio))
+		if len(regressions) > 0:
+			sys.exit(1)
+		print("No regression compared to", args.compare)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,84 @@
+"""
+
+Just enough of the sublime module to import NimPlus outside of Sublime Text.
+Only used by the benchmarks.
+
+"""
+
+import tempfile
+import threading
+
+KIND_AMBIGUOUS = (0, "", "")
+KIND_FUNCTION = (4, "f", "Function")
+KIND_VARIABLE = (6, "v", "Variable")
+KIND_TYPE = (5, "t", "Type")
+
+INHIBIT_WORD_COMPLETIONS = 8
+ENCODED_POSITION = 1
+HIDE_ON_MOUSE_MOVE_AWAY = 2
+DRAW_NO_FILL = 32
+DRAW_NO_OUTLINE = 256
+DRAW_SQUIGGLY_UNDERLINE = 1024
+
+settings = {}
+
+class Settings:
+	def get(self, key, default = None):
+		return settings.get(key, default)
+	def set(self, key, value):
+		settings[key] = value
+
+def load_settings(name):
+	return Settings()
+
+def set_timeout(callback, delay = 0):
+	timer = threading.Timer(delay / 1000.0, callback)
+	timer.daemon = True
+	timer.start()
+
+set_timeout_async = set_timeout
+
+def cache_path():
+	return tempfile.gettempdir()
+
+def status_message(message):
+	pass
+
+def message_dialog(message):
+	pass
+
+def active_window():
+	return None
+
+def windows():
+	return []
+
+class Region:
+	def __init__(self, a, b = None):
+		self.a = a
+		self.b = a if b == None else b
+	def begin(self):
+		return min(self.a, self.b)
+	def end(self):
+		return max(self.a, self.b)
+
+class View:
+	pass
+
+class CompletionItem:
+	def __init__(self, trigger, annotation = "", completion = "", completion_format = 0, kind = KIND_AMBIGUOUS, details = ""):
+		self.trigger = trigger
+		self.annotation = annotation
+		self.completion = completion
+		self.kind = kind
+		self.details = details
+
+class CompletionList:
+	def __init__(self, completions = None, flags = 0):
+		self.completions = completions
+		self.flags = flags
+		self.done = threading.Event()
+	def set_completions(self, completions, flags = 0):
+		self.completions = completions
+		self.flags = flags
+		self.done.set()
@@ -0,0 +1,26 @@
+"""
+
+Just enough of the sublime_plugin module to import NimPlus outside of Sublime Text.
+Only used by the benchmarks.
+
+"""
+
+class EventListener:
+	pass
+
+class ViewEventListener:
+	pass
+
+class WindowCommand:
+	def __init__(self, window = None):
+		self.window = window
+
+class TextCommand:
+	def __init__(self, view = None):
+		self.view = view
+
+class ListInputHandler:
+	pass
+
+class TextInputHandler:
+	pass
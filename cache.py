@@ -0,0 +1,75 @@
+"""
+
+Small in-memory caches used to avoid asking nimsuggest
+the same thing twice.
+
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+class LRUCache:
+	"""
+	Dictionary keeping at most maxSize entries.
+	When full, the least recently used entry is dropped.
+	get counts hits and misses, peek does not.
+	"""
+	def __init__(self, maxSize = 128):
+		self.maxSize = maxSize
+		self.entries = OrderedDict()
+		self.lock = Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def __len__(self):
+		return len(self.entries)
+
+	def peek(self, key, default = None):
+		with self.lock:
+			if key not in self.entries:
+				return default
+			self.entries.move_to_end(key)
+			return self.entries[key]
+
+	def get(self, key, default = None):
+		with self.lock:
+			if key not in self.entries:
+				self.misses += 1
+				return default
+			self.hits += 1
+			self.entries.move_to_end(key)
+			return self.entries[key]
+
+	def put(self, key, value):
+		with self.lock:
+			self.entries[key] = value
+			self.entries.move_to_end(key)
+			while len(self.entries) > self.maxSize:
+				self.entries.popitem(last = False)
+
+	def pop(self, key, default = None):
+		with self.lock:
+			return self.entries.pop(key, default)
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+
+	def items(self):
+		# Copy, so that the cache can be modified while iterating.
+		with self.lock:
+			return list(self.entries.items())
+
+	def recordHit(self):
+		self.hits += 1
+
+	def recordMiss(self):
+		self.misses += 1
+
+	def stats(self):
+		return {
+			"size": len(self.entries),
+			"maxSize": self.maxSize,
+			"hits": self.hits,
+			"misses": self.misses
+		}
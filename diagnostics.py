@@ -0,0 +1,236 @@
+"""
+
+Errors and warnings found by nim check or nimsuggest,
+and the squiggly regions showing them inside the views.
+
+"""
+
+import re
+import sublime
+from collections import OrderedDict
+from bisect import bisect_right
+from threading import RLock
+from html import escape
+
+# path(line, col) Severity: Description
+check_message_format = re.compile(r"^(.*?)\((\d+), ?(\d+)\) (\w+): (.*)$")
+
+region_draw_flag = sublime.DRAW_SQUIGGLY_UNDERLINE + sublime.DRAW_NO_FILL + sublime.DRAW_NO_OUTLINE
+
+class Diagnostic:
+	"""
+	A message about a position in a file. line and col start at 1.
+	"""
+	def __init__(self, filename, line, col, severity, message):
+		self.filename = filename
+		self.line = line
+		self.col = col
+		self.severity = severity
+		self.message = message
+
+	def html(self):
+		return escape(self.severity + ": " + self.message)
+
+def parse_check_message(check_message):
+	"""
+	Parse a line printed by nim check.
+	Returns None if the line is not a message about a position.
+	"""
+	match = check_message_format.match(check_message.rstrip("\r\n"))
+	if match == None:
+		return None
+	filename, line, col, severity, message = match.groups()
+	return Diagnostic(filename, int(line), int(col), severity, message)
+
+def region_key(severity):
+	return "nimplus." + severity.lower()
+
+def region_style(severity):
+	# scope, icon
+	if severity == "Error":
+		return "region.redish", "panel_close" # a 'x' icon
+	return "region.cyanish", "panel_close"
+
+class IndexEntry:
+	def __init__(self, begin, end, severity, html):
+		self.begin = begin
+		self.end = end
+		self.severity = severity
+		self.html = html
+
+class ViewDiagnostics:
+	"""
+	Diagnostics drawn inside a view. Every severity has one region key and
+	an index sorted by position finds the message under the mouse with a
+	binary search. Diagnostics on the same word share one region.
+	Drawn by the worker threads, read by on_hover: the lock keeps the index
+	and its starts consistent.
+	"""
+	def __init__(self, view):
+		self.view = view
+		self.lock = RLock()
+		self.diagnostics = []
+		self.keys = set()
+		self.index = [] # IndexEntry sorted by begin
+		self.starts = [] # begin of every entry of index
+		self.changeCount = 0
+
+	def set(self, diagnostics):
+		with self.lock:
+			self.diagnostics = list(diagnostics)
+			self.draw()
+
+	def add(self, diagnostics):
+		with self.lock:
+			self.diagnostics.extend(diagnostics)
+			self.draw()
+
+	def clear(self):
+		self.set([])
+
+	def draw(self):
+		# Called with the lock.
+		view = self.view
+		entries = {} # (begin, end) -> IndexEntry
+		for d in self.diagnostics:
+			# To compute point end,
+			# we need to find the token length as errors seem to
+			# always span exactly one token in Nim.
+			word = view.word(view.text_point(d.line-1, d.col-1))
+			entry = entries.get((word.begin(), word.end()))
+			if entry == None:
+				entries[(word.begin(), word.end())] = IndexEntry(word.begin(), word.end(), d.severity, d.html())
+			else:
+				entry.html += "<br/>" + d.html()
+				if d.severity == "Error":
+					entry.severity = d.severity
+
+		self.index = sorted(entries.values(), key = lambda e: e.begin)
+		self.starts = [e.begin for e in self.index]
+		self.changeCount = view.change_count()
+
+		regions = {} # severity -> regions
+		for entry in self.index:
+			regions.setdefault(entry.severity, []).append(sublime.Region(entry.begin, entry.end))
+		keys = set()
+		for severity in regions:
+			key = region_key(severity)
+			keys.add(key)
+			scope, icon = region_style(severity)
+			view.add_regions(
+				key=key,
+				regions=regions[severity],
+				scope=scope,
+				icon=icon,
+				flags=region_draw_flag
+			)
+		for key in self.keys - keys:
+			view.erase_regions(key)
+		self.keys = keys
+
+	def refresh(self):
+		"""
+		The regions move with the text when the view is edited,
+		the positions of the index are updated from them.
+		"""
+		view = self.view
+		with self.lock:
+			if view.change_count() == self.changeCount:
+				return
+			self.changeCount = view.change_count()
+			for key in self.keys:
+				regions = view.get_regions(key)
+				entries = [e for e in self.index if region_key(e.severity) == key]
+				if len(regions) != len(entries):
+					continue # merged by Sublime, keep the old positions.
+				for entry, region in zip(entries, regions):
+					entry.begin = region.begin()
+					entry.end = region.end()
+			self.index.sort(key = lambda e: e.begin)
+			self.starts = [e.begin for e in self.index]
+
+	def messageAt(self, point):
+		"""
+		HTML of the messages at point, or None.
+		"""
+		with self.lock:
+			self.refresh()
+			# Words do not overlap: only the last region starting
+			# before point can contain it.
+			i = bisect_right(self.starts, point) - 1
+			if i >= 0 and self.index[i].end >= point:
+				return self.index[i].html
+			return None
+
+# view id -> ViewDiagnostics
+view_diagnostics = {}
+
+def diagnostics_of(view):
+	d = view_diagnostics.get(view.id())
+	if d == None:
+		d = ViewDiagnostics(view)
+		view_diagnostics[view.id()] = d
+	return d
+
+class ProjectDiagnostics:
+	"""
+	Diagnostics of every file of a project found by the last check,
+	including the files that are not open.
+	"""
+	def __init__(self, root):
+		self.root = root
+		self.files = OrderedDict() # filename -> list of Diagnostic
+		self.seen = set() # the same message can be reported more than once
+
+	def set(self, diagnostics):
+		"""
+		Replace the diagnostics of the project.
+		Returns the files whose diagnostics changed.
+		"""
+		changed = set(self.files.keys())
+		self.files = OrderedDict()
+		self.seen = set()
+		return changed | self.add(diagnostics)
+
+	def add(self, diagnostics):
+		changed = set()
+		for d in diagnostics:
+			key = (d.filename, d.line, d.col, d.message)
+			if key in self.seen:
+				continue
+			self.seen.add(key)
+			self.files.setdefault(d.filename, []).append(d)
+			changed.add(d.filename)
+		return changed
+
+	def all(self):
+		return [d for diagnostics in self.files.values() for d in diagnostics]
+
+# project root -> ProjectDiagnostics
+project_diagnostics = {}
+
+def project_diagnostics_of(root):
+	store = project_diagnostics.get(root)
+	if store == None:
+		store = ProjectDiagnostics(root)
+		project_diagnostics[root] = store
+	return store
+
+def stored_diagnostics(filename):
+	"""
+	Diagnostics of a file from the store of any project.
+	"""
+	for store in project_diagnostics.values():
+		if filename in store.files:
+			return store.files[filename]
+	return []
+
+def show_diagnostics(store, filenames):
+	"""
+	Draw the diagnostics of the given files inside the views where they are open.
+	"""
+	for window in sublime.windows():
+		for filename in filenames:
+			view = window.find_open_file(filename)
+			if view != None:
+				diagnostics_of(view).set(store.files.get(filename, []))
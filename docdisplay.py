@@ -3,35 +3,158 @@
 Nim documentation uses a weird RST like format.
 This file converts the RST into something that can be nicely displayed by Sublime.
 
+Only the parts of RST that appear in docstrings are understood: paragraphs,
+bullet lists, code blocks (".. code-block::", ".. code::", "::") and inline
+markup (`code`, ``code``, `links <url>`_, **strong**, *emphasis*).
+The text is read once, line by line, and every inline markup of a line is
+found by a single regular expression.
+
 """
 
-def cpublish_string(s):
-	# A custom RST parser for poor people.
-	# I won't use docutils.
-	s = s.replace("\n","<br/>")
-	s = s.replace("\\'","'")
-	s = s.replace("\\\"","\"")
-
-	# Replace `a` => <code>a</code>
-	r = [] # string builder thing
-	inCode = False
-
-	for i in range(len(s)):
-		if s[i] != '`':
-			r.append(s[i])
-		else:
-			if inCode:
-				r.append("</code>")
+import re
+
+from NimPlus.cache import LRUCache
+from NimPlus.nimsuggest import unescape_nim_string
+
+docs_url = "https://nim-lang.org/docs/"
+
+# ``literal`` | `text <url>`_ | `code` or `reference`_ | **strong** | *emphasis*
+inline_format = re.compile(
+	r"``(?P<literal>.+?)``"
+	r"|`(?P<label>[^`<]+?)\s*<(?P<url>[^>`]+)>`_{1,2}"
+	r"|`(?P<code>[^`]+)`(?P<ref>_{0,2})"
+	r"|\*\*(?P<strong>[^*]+)\*\*"
+	# Like in RST, no emphasis in the middle of a word: 2*x*y is a product.
+	r"|(?<![\w*])\*(?P<emphasis>[^*\s][^*]*)\*"
+)
+directive_format = re.compile(r"^\.\.\s+(code-block|code|sourcecode)::")
+bullet_format = re.compile(r"^[*+-]\s+")
+
+html_escapes = {"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#39;"}
+html_format = re.compile(r"[&<>\"']")
+
+def escape_html(s):
+	return html_format.sub(lambda m: html_escapes[m.group(0)], s)
+
+def link_target(url):
+	# Links between the pages of the documentation are relative.
+	if re.match(r"^[a-z]+://", url):
+		return url
+	if ".html" in url:
+		return docs_url + url
+	return None
+
+def render_inline(text):
+	parts = []
+	position = 0
+	for match in inline_format.finditer(text):
+		parts.append(escape_html(text[position:match.start()]))
+		position = match.end()
+		if match.group("literal") != None:
+			parts.append("<code>%s</code>" % escape_html(match.group("literal")))
+		elif match.group("url") != None:
+			target = link_target(match.group("url"))
+			label = escape_html(match.group("label"))
+			if target != None:
+				parts.append('<a href="%s">%s</a>' % (escape_html(target), label))
+			else:
+				parts.append(label)
+		elif match.group("code") != None:
+			if match.group("ref"): # a reference to a title or a symbol
+				parts.append(escape_html(match.group("code")))
 			else:
-				r.append("<code>")
-			inCode = not inCode
+				parts.append("<code>%s</code>" % escape_html(match.group("code")))
+		elif match.group("strong") != None:
+			parts.append("<b>%s</b>" % escape_html(match.group("strong")))
+		else:
+			parts.append("<i>%s</i>" % escape_html(match.group("emphasis")))
+	parts.append(escape_html(text[position:]))
+	return "".join(parts)
+
+def render_code(lines):
+	# minihtml has no <pre>: keep the spaces and line breaks by hand.
+	while len(lines) > 0 and len(lines[-1].strip()) == 0:
+		lines.pop()
+	while len(lines) > 0 and len(lines[0].strip()) == 0:
+		lines.pop(0)
+	if len(lines) == 0:
+		return ""
+	indent = min((len(l) - len(l.lstrip()) for l in lines if len(l.strip()) > 0), default = 0)
+	body = "<br/>".join(escape_html(l[indent:]).replace(" ", "&nbsp;") for l in lines)
+	return '<div class="code"><code>%s</code></div>' % body
 
-	# TODO: handle this
+def cpublish_string(s):
 	"""
-	.. code-block:: nim
-		# some code written in nim
-		# some more
-	End of the indented block !
+	HTML of a docstring (already unescaped).
 	"""
+	html = []
+	paragraph = [] # lines of the current paragraph
+	code = None # lines of the current code block
+	codeIndent = 0 # lines of the code block are more indented than this
 
-	return ''.join(r)
\ No newline at end of file
+	def end_paragraph():
+		if len(paragraph) > 0:
+			html.append("<p>%s</p>" % render_inline(" ".join(paragraph)))
+			paragraph.clear()
+
+	for line in s.split("\n"):
+		stripped = line.strip()
+		indent = len(line) - len(line.lstrip())
+		if code != None:
+			if len(stripped) == 0 or indent > codeIndent:
+				code.append(line)
+				continue
+			html.append(render_code(code))
+			code = None
+		if len(stripped) == 0:
+			end_paragraph()
+			continue
+		if directive_format.match(stripped):
+			end_paragraph()
+			code = []
+			codeIndent = indent
+			continue
+		if bullet_format.match(stripped):
+			end_paragraph()
+			html.append("&bull; %s<br/>" % render_inline(bullet_format.sub("", stripped)))
+			continue
+		if stripped.endswith("::"): # literal block after this line
+			text = stripped[:-2].rstrip()
+			if len(text) > 0:
+				paragraph.append(text + ":")
+			end_paragraph()
+			code = []
+			codeIndent = indent
+			continue
+		paragraph.append(stripped)
+	if code != None:
+		html.append(render_code(code))
+	end_paragraph()
+	return "".join(html)
+
+def summarize(s, length = 90):
+	"""
+	First paragraph of a docstring (already unescaped), cut after length characters.
+	"""
+	first = s.strip().split("\n\n")[0]
+	text = " ".join(first.split())
+	if len(text) > length:
+		text = text[:length] + "..."
+	return render_inline(text)
+
+# The same docstrings are displayed again and again.
+# (docstring as sent by nimsuggest, summary) -> html
+rendered = LRUCache(4096)
+
+def render_docstring(docstring, summary = False):
+	"""
+	HTML of a docstring as sent by nimsuggest (quoted and escaped).
+	summary: only the beginning, for the completion popup.
+	"""
+	key = (docstring, summary)
+	html = rendered.get(key)
+	if html == None:
+		text = unescape_nim_string(docstring)
+		html = summarize(text) if summary else cpublish_string(text)
+		rendered.put(key, html)
+	return html
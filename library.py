@@ -0,0 +1,183 @@
+"""
+
+Definitions of the symbols of the standard library and of the nimble packages,
+kept on disk between sessions. The hover popup can use them while nimsuggest
+is still compiling the project.
+
+There is one file per version of Nim. Each line is a name, a tab and the json
+list of the definitions with this name, sorted by name: the file is memory
+mapped and searched by bisection, nothing is loaded in memory.
+A definition remembers the mtime of its source file: when a package is
+updated in place, its old definitions are ignored.
+
+"""
+
+import os
+import re
+import json
+import mmap
+import subprocess
+from threading import Lock
+
+import sublime
+
+from NimPlus.nimsuggest import SymbolDefinition
+
+def nim_version():
+	"""
+	Version of the nim in the PATH, like "2.0.4", or "unknown".
+	"""
+	try:
+		output = subprocess.run(
+			["nim", "--version"],
+			stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=10
+		).stdout.decode("utf-8", "replace")
+	except (OSError, subprocess.SubprocessError):
+		return "unknown"
+	match = re.search(r"Version (\S+)", output)
+	return match.group(1) if match != None else "unknown"
+
+class LibraryDefinitions:
+	"""
+	name -> definitions (qualified name, kind, type, file, line, col, docstring, mtime).
+	New definitions stay in memory until save merges them into the file.
+	"""
+	def __init__(self, path):
+		self.path = path
+		self.lock = Lock()
+		self.pending = {}
+		self.file = None
+		self.map = None
+		self.open()
+
+	def open(self):
+		try:
+			self.file = open(self.path, "rb")
+			self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		except (OSError, ValueError): # missing or empty
+			self.close()
+
+	def close(self):
+		if self.map != None:
+			self.map.close()
+		if self.file != None:
+			self.file.close()
+		self.map = None
+		self.file = None
+
+	def stored(self, name):
+		# Bisection on the lines of the file.
+		if self.map == None:
+			return []
+		key = name.encode("utf-8")
+		data = self.map
+		lo, hi = 0, len(data)
+		while lo < hi:
+			mid = (lo + hi) // 2
+			start = data.rfind(b"\n", 0, mid) + 1
+			end = data.find(b"\n", start)
+			if end < 0:
+				end = len(data)
+			tab = data.find(b"\t", start, end)
+			current = data[start:tab]
+			if current == key:
+				return json.loads(data[tab+1:end].decode("utf-8"))
+			if current < key:
+				lo = end + 1
+			else:
+				hi = start
+		return []
+
+	def lookup(self, name):
+		"""
+		SymbolDefinitions of the library symbols called name.
+		"""
+		with self.lock:
+			records = self.pending.get(name) or self.stored(name)
+		definitions = []
+		mtimes = {}
+		for record in records:
+			filename = record[3]
+			if filename not in mtimes:
+				try:
+					mtimes[filename] = os.stat(filename).st_mtime
+				except OSError:
+					mtimes[filename] = None
+			if mtimes[filename] != record[7]:
+				continue # the file changed since
+			sd = SymbolDefinition()
+			sd.fullname, sd.kind, sd.symbolType, sd.filename, sd.line, sd.col, sd.docstring = record[:7]
+			sd.shortName = name
+			definitions.append(sd)
+		return definitions
+
+	def add(self, definitions):
+		"""
+		Remember definitions (SymbolDefinition or Suggestion) found by nimsuggest.
+		Returns the number of definitions waiting to be saved.
+		"""
+		mtimes = {}
+		with self.lock:
+			for d in definitions:
+				if isinstance(d, SymbolDefinition):
+					record = [d.fullname, d.kind, d.symbolType, d.filename, d.line, d.col, d.docstring]
+				else:
+					record = [d.qualifiedName, d.kind, d.signature, d.filename, int(d.line), int(d.col), d.docstring]
+				if record[3] not in mtimes:
+					try:
+						mtimes[record[3]] = os.stat(record[3]).st_mtime
+					except OSError:
+						mtimes[record[3]] = None
+				if mtimes[record[3]] == None:
+					continue
+				record.append(mtimes[record[3]])
+				name = record[0].rpartition(".")[2]
+				if name not in self.pending:
+					self.pending[name] = self.stored(name)
+				records = self.pending[name]
+				# Same symbol: replace what we knew about it.
+				records[:] = [r for r in records if r[:1] + r[3:6] != record[:1] + record[3:6]]
+				records.append(record)
+			return len(self.pending)
+
+	def save(self):
+		"""
+		Merge the new definitions into the file.
+		"""
+		with self.lock:
+			if len(self.pending) == 0:
+				return
+			lines = {}
+			if self.map != None:
+				for line in iter(self.map.readline, b""):
+					name, _, rest = line.partition(b"\t")
+					lines[name] = rest.rstrip(b"\n")
+				self.map.seek(0)
+			for name, records in self.pending.items():
+				lines[name.encode("utf-8")] = json.dumps(records, separators=(",", ":")).encode("utf-8")
+			try:
+				os.makedirs(os.path.dirname(self.path), exist_ok=True)
+				with open(self.path + ".tmp", "wb") as f:
+					for name in sorted(lines.keys()):
+						f.write(name + b"\t" + lines[name] + b"\n")
+				self.close()
+				os.replace(self.path + ".tmp", self.path)
+			except OSError as err:
+				print("NimPlus:", "could not save the library definitions:", err)
+			self.pending.clear()
+			self.open()
+
+store = None # LibraryDefinitions of the current nim, once its version is known
+store_lock = Lock()
+
+def library_definitions():
+	"""
+	The definitions of the nim in the PATH. The first call runs nim --version,
+	use store to avoid waiting for it.
+	"""
+	global store
+	with store_lock:
+		if store == None:
+			path = os.path.join(sublime.cache_path(), "NimPlus", "library", "nim-%s.txt" % nim_version())
+			store = LibraryDefinitions(path)
+		return store
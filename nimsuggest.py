@@ -2,16 +2,19 @@ import subprocess
 import sublime
 import time
 import sys
-from queue import Queue
-from threading import Thread
+from queue import Queue, Empty, Full
+from threading import Thread, Lock, Event
+from collections import OrderedDict, deque
 import os
+import re
+import signal
+
+from NimPlus.project import find_project_root
+from NimPlus import perf
 
 isWindows = sys.platform == "win32"
 settings = sublime.load_settings('NimPlus.sublime-settings')
 
-if not isWindows:
-	import select
-
 nimsuggest_options = [
 	"--stdin",
 	"--debug",
@@ -22,22 +25,87 @@ nimsuggest_options = [
 if settings.get("nimplus.nimsuggest.options"):
 	nimsuggest_options = settings.get("nimplus.nimsuggest.options")
 
+# Put in the output queue to wake up the dispatcher without any output.
+WAKE_UP = object()
+
+# Seconds between two health checks of the nimsuggest processes.
+supervise_interval = 2
+# Delay before restarting a process that died, doubled after every failure.
+restart_backoff = 1
+max_restart_backoff = 60
+# Chunks of output waiting for the dispatcher. When it is full, the reader
+# waits and nimsuggest with it instead of filling the memory.
+output_queue_size = 256
+# Requests waiting to be written, the oldest are dropped past this.
+max_pending = 100
+# Lines of stderr kept for the log command.
+log_size = 1000
+
 def output_to_queue(output_stream, queue):
-	if not isWindows:
-		poll_obj = select.poll()
-		poll_obj.register(output_stream, select.EPOLLIN)
-		# Wait a bit for the object to be available for polling.
-		while not output_stream.closed:
-			if poll_obj.poll(1):
-				if output_stream.closed: break
-				line = output_stream.readline()
-				if line == b'': break # means eof.
-				queue.put(line)
-		output_stream.close()
-	else:
-		for line in iter(output_stream.readline, b''):
-			queue.put(line)
-		output_stream.close()
+	# Blocking reads of whatever is available, split into lines:
+	# one item in the queue per chunk instead of one per line.
+	partial = b""
+	for chunk in iter(lambda: output_stream.read1(65536), b''):
+		lines = (partial + chunk).split(b"\n")
+		partial = lines.pop() # not terminated yet, like the "> " prompt
+		if len(lines) > 0:
+			queue.put(lines)
+	if len(partial) > 0:
+		queue.put([partial])
+	output_stream.close()
+	queue.put(None) # eof
+
+def output_to_log(output_stream, log):
+	# With --debug, nimsuggest writes a lot to stderr. If nobody reads it,
+	# the pipe fills up and nimsuggest blocks.
+	for line in iter(lambda: output_stream.readline(4096), b''):
+		log.append(line.decode("utf-8", "replace").rstrip("\r\n"))
+	output_stream.close()
+
+def stop_process(process):
+	"""
+	Stop nimsuggest and the shell it was started with.
+	"""
+	try:
+		process.stdin.close()
+	except:
+		pass
+	try:
+		if isWindows:
+			process.terminate()
+		else:
+			os.killpg(process.pid, signal.SIGTERM)
+		process.wait(timeout=0.2)
+	except subprocess.TimeoutExpired:
+		if isWindows:
+			process.kill()
+		else:
+			os.killpg(process.pid, signal.SIGKILL)
+	except OSError:
+		pass # already stopped
+
+def process_memory(pid):
+	"""
+	Resident memory in bytes of a process and of its children, read from /proc.
+	Returns None when it is not available (Windows, macOS).
+	"""
+	try:
+		page_size = os.sysconf("SC_PAGE_SIZE")
+	except (AttributeError, ValueError, OSError):
+		return None
+	total = 0
+	pids = [pid]
+	while len(pids) > 0:
+		current = pids.pop()
+		try:
+			with open("/proc/%d/statm" % current) as f:
+				total += int(f.read().split()[1]) * page_size
+			with open("/proc/%d/task/%d/children" % (current, current)) as f:
+				pids.extend(int(child) for child in f.read().split())
+		except (OSError, ValueError):
+			if current == pid:
+				return None
+	return total
 
 def parent_directory(d):
 	return os.path.abspath(os.path.join(d, os.pardir))
@@ -53,19 +121,214 @@ class SymbolDefinition:
 	docstring = ""
 	raw = []
 
+class Suggestion:
+	"""
+	One row of a sug response.
+	There can be thousands of them, so no __dict__ for each.
+	"""
+	__slots__ = ["kind", "qualifiedName", "name", "signature", "filename", "line", "col", "docstring", "quality"]
+
+	def __init__(self, data):
+		self.kind = data[1]
+		self.qualifiedName = data[2]
+		self.name = data[2].rpartition(".")[2] # without the module prefix
+		self.signature = data[3]
+		self.filename = data[4]
+		self.line = data[5]
+		self.col = data[6]
+		self.docstring = data[7] # still quoted and escaped
+		self.quality = data[8]
+
+def format_location(filename, line, col, dirtyFile = None):
+	"""
+	Location argument of a query. With a dirty file, nimsuggest
+	reads the content of the file from it instead of filename.
+	"""
+	location = "\"" + filename + "\""
+	if dirtyFile != None:
+		location += ";\"" + dirtyFile + "\""
+	# lines are 1-indexed for nimsuggest.
+	return location + ":" + str(line+1) + ":" + str(col)
+
+def parse_symbol(line):
+	"""
+	SymbolDefinition of a def or use line, None for other lines.
+	col starts at 0.
+	"""
+	data = line.split("\t")
+	if len(data) != 9:
+		return None
+	sd = SymbolDefinition()
+	sd.kind = data[1]
+	sd.fullname= data[2]
+	sd.shortName = data[2].rpartition(".")[2]
+	sd.symbolType = data[3]
+	sd.filename = data[4]
+	sd.line = int(data[5])
+	sd.col = int(data[6])
+	sd.docstring = data[7]
+	sd.raw = data
+	return sd
+
+def parse_definition(lines):
+	"""
+	Build a SymbolDefinition from the lines of a def response.
+	Returns None if nothing was found.
+	"""
+	for line in lines:
+		sd = parse_symbol(line)
+		if sd != None:
+			return sd
+	return None
+
+# Suggestions kept from a sug response, the other ones are ignored.
+max_suggestions = 1000
+
+def parse_suggestions(lines):
+	"""
+	Suggestion records of the lines of a sug response.
+	"""
+	suggestions = []
+	for line in lines:
+		data = line.split("\t")
+		if len(data) == 10:
+			suggestions.append(Suggestion(data))
+		if len(suggestions) > max_suggestions:
+			break # no need for tones of suggestions.
+	return suggestions
+
+def suggestions_truncated(count):
+	"""
+	True if a sug response with count suggestions may have been cut,
+	by the --maxresults option of nimsuggest or by parse_suggestions.
+	"""
+	if count > max_suggestions:
+		return True
+	for option in nimsuggest_options:
+		if option.startswith("--maxresults:"):
+			try:
+				limit = int(option.split(":", 1)[1])
+			except ValueError:
+				continue
+			if limit > 0 and count >= limit:
+				return True
+	return False
+
+# A run of \xHH escapes, or any other escaped character.
+escape_format = re.compile(r"((?:\\x[0-9a-fA-F]{2})+)|\\(.)")
+
+def unescape_nim_string(s):
+	"""
+	Strings like docstrings and messages are quoted and escaped by nimsuggest.
+	Every byte outside of printable ASCII is a \\xHH escape: the bytes of a
+	run of escapes are decoded together, as utf-8.
+	"""
+	if len(s) >= 2 and s[0] == '"' and s[-1] == '"':
+		s = s[1:-1]
+	def replace(match):
+		if match.group(1) != None:
+			data = bytes(int(h, 16) for h in match.group(1).split("\\x")[1:])
+			return data.decode("utf-8", "replace")
+		return match.group(2)
+	return escape_format.sub(replace, s)
+
+def parse_check_results(lines):
+	"""
+	Messages of a chk response as (filename, line, col, severity, message) tuples.
+	Like with nim check, line and col start at 1.
+	"""
+	messages = []
+	for line in lines:
+		data = line.split("\t")
+		if len(data) < 8 or data[0] != "chk":
+			continue
+		messages.append((data[4], int(data[5]), int(data[6]) + 1, data[3], unescape_nim_string(data[7])))
+	return messages
+
+class NimsuggestRequest:
+	"""
+	A query waiting for its response. The lines of the response
+	are collected by the reader of the Nimsuggest instance and
+	handed to onResponse once the response is complete.
+
+	key: a newer request with the same key replaces this one if it was not written yet.
+	isStale: returns True when the answer is not needed anymore
+	(for example because the view changed).
+	debounce: number of seconds to wait before writing the query, so that
+	a burst of requests with the same key only sends the last one.
+	onLine: called with every line of the response as it arrives, before onResponse.
+	"""
+	def __init__(self, query, onResponse, timeout = None, key = None, isStale = None, debounce = 0, onLine = None):
+		self.query = query
+		self.command = query.split(" ", 1)[0] # name used for the timings
+		self.onResponse = onResponse
+		self.lines = []
+		self.createdAt = time.time()
+		self.writtenAt = None
+		self.firstLineAt = None
+		self.started = False
+		self.answered = False
+		if timeout == None:
+			timeout = settings.get("nimplus.nimsuggest.timeout", 10)
+		self.timeout = timeout
+		self.deadline = None # set when the query is written
+		self.key = key
+		self.isStale = isStale
+		self.notBefore = time.time() + debounce
+		self.ok = False # True if answered with the actual response
+		self.dropped = False # True if a newer request with the same key replaced it
+		self.onLine = onLine
+
+	def stale(self):
+		return self.isStale != None and self.isStale()
+
+	def answer(self, lines, ok = False):
+		# Only the first answer counts: a response arriving after
+		# the timeout is thrown away.
+		if self.answered:
+			return
+		self.answered = True
+		self.ok = ok
+		try:
+			self.onResponse(lines)
+		except Exception as err:
+			print("NimPlus:","Unexpected error:", sys.exc_info()[0])
+			print(err)
+
 class Nimsuggest:
 	"""
 	Represents a nimsuggest instance.
 	Reference: https://nim-lang.org/docs/nimsuggest.html
+
+	Requests are answered in the order they are sent, so they are queued
+	and written one at a time: the next query is written when the response of
+	the previous one is complete. A single dispatcher thread reads the output
+	and hands every response to the request it belongs to.
+
+	The pool checks the health of the process regularly (see checkHealth):
+	a process that dies or stops answering is restarted, waiting longer
+	after each failure, and a process that served too many requests or uses
+	too much memory is replaced by a fresh one.
 	"""
-	def __init__(self, filePath):
+	def __init__(self, filePath, projectPath = None):
+		if projectPath == None:
+			projectPath = parent_directory(filePath)
+		self.projectPath = projectPath
+		self.lock = Lock()
+		self.pending = deque() # requests not written yet
+		self.statusView = None
+		self.failures = 0 # deaths since the last answered request
+		self.restartAt = 0 # no restart before this time after a failure
+		self.restarts = 0
+		self.memory = None
+		self.log = deque(maxlen = log_size) # last lines of stderr
+		self.inflight = None # request written, waiting for its response
 		self.setup(filePath)
 
 	def setup(self, filePath): 
-		self.projectPath = parent_directory(filePath)
 		self.filePath = filePath
 		
-		args = ["nimsuggest"] + nimsuggest_options
+		args = [settings.get("nimplus.nimsuggest.path", "nimsuggest")] + nimsuggest_options
 		if not isWindows:
 			args.append("\""+ filePath +"\"")
 		else:
@@ -76,55 +339,163 @@ class Nimsuggest:
 		if not isWindows:
 			args = [" ".join(args)]
 
-		self.process = subprocess.Popen(
+		process = subprocess.Popen(
 			args,
 			cwd=self.projectPath,
 			stdin=subprocess.PIPE,
 			stdout=subprocess.PIPE,
 			stderr=subprocess.PIPE,
-			shell=True
+			shell=True,
+			# Own process group: the shell and nimsuggest are stopped together.
+			start_new_session=not isWindows
 		)
 
-		self.ready = False
-		self.gettingReady = True
-		self.input_queue = Queue()
-		self.output_queue = Queue()
+		# nimsuggest only answers once the project is compiled.
+		# The first answer to a cheap query tells us it is ready, until then
+		# the other requests wait behind it. The garbage printed when
+		# nimsuggest starts is ignored by the dispatcher.
+		probe = NimsuggestRequest(
+			"def \"" + filePath + "\":1:0",
+			lambda lines: self.onReady(probe),
+			timeout = settings.get("nimplus.nimsuggest.startup_timeout", 120)
+		)
+		probe.command = "probe"
+
+		# Requests can be submitted while the process starts: the switch
+		# to the new process is done at once.
+		with self.lock:
+			orphan = self.inflight # written to the previous process, it will not answer
+			self.process = process
+			self.ready = False
+			self.gettingReady = True
+			self.stopped = False
+			self.requestCount = 0
+			self.primed = set() # files nimsuggest was already asked about
+			self.startTime = time.time()
+			self.timeToReady = None
+			self.inflight = None
+			output_queue = Queue(output_queue_size)
+			self.output_queue = output_queue
+			self.pending.appendleft(probe)
+		if orphan != None:
+			orphan.answer([])
+
+		# Only one reader: the order of the lines is what tells to
+		# which request they belong.
 		self.stdout_thread = Thread(
 			target=output_to_queue,
-			args=(self.process.stdout, self.output_queue)
+			args=(process.stdout, output_queue)
 		)
+		self.stdout_thread.daemon = True
+		self.stdout_thread.start()
+
+		self.log.append("NimPlus: started " + args[0])
 		self.stderr_thread = Thread(
-			target=output_to_queue,
-			args=(self.process.stdout, self.output_queue)
+			target=output_to_log,
+			args=(process.stderr, self.log)
 		)
-		self.stdout_thread.daemon = True
 		self.stderr_thread.daemon = True
-
-		self.stdout_thread.start()
 		self.stderr_thread.start()
 
-		# When nimsuggest starts, it spits out a bit of garbage.
-		# We flush this garbage inside another thread to prevent
-		# lag inside the editor
-		t = Thread(target=self.flush_queue)
-		t.daemon = True
-		t.start()
-
-	def flush_queue(self, waitTime = 2.0):
-		time.sleep(waitTime)
-		while not self.output_queue.empty():
-			self.output_queue.get(block=False)
+		self.dispatch_thread = Thread(
+			target=self.dispatchResponses,
+			args=(process, output_queue)
+		)
+		self.dispatch_thread.daemon = True
+		self.dispatch_thread.start()
+
+		self.sendNext()
+		sublime.set_timeout(self.showIndexingStatus, 0)
+
+	def onReady(self, probe):
+		if not probe.ok:
+			# Timed out: nimsuggest is still compiling, completeInflight calls
+			# this again when the answer comes. Or the process died and the
+			# dispatcher takes care of it.
+			return
+		self.timeToReady = time.time() - self.startTime
+		perf.record("nimsuggest.spawn_to_ready", self.timeToReady)
 		self.ready = True
 		self.gettingReady = False
+		sublime.set_timeout(self.showReadyStatus, 0)
+
+	def projectName(self):
+		return os.path.basename(self.projectPath)
+
+	def setStatus(self, text):
+		window = sublime.active_window()
+		view = window.active_view() if window != None else None
+		if self.statusView != None and self.statusView != view:
+			self.statusView.erase_status("nimplus.nimsuggest")
+		self.statusView = view
+		if view != None:
+			view.set_status("nimplus.nimsuggest", text)
+
+	def showIndexingStatus(self):
+		if not self.gettingReady:
+			return
+		self.setStatus("NimPlus: indexing %s (%.1fs)" % (self.projectName(), time.time() - self.startTime))
+		sublime.set_timeout(self.showIndexingStatus, 500)
+
+	def showReadyStatus(self):
+		if self.ready:
+			self.setStatus("NimPlus: %s ready in %.1fs" % (self.projectName(), self.timeToReady))
+		else:
+			self.setStatus("NimPlus: nimsuggest stopped")
+		def clear():
+			if self.statusView != None:
+				self.statusView.erase_status("nimplus.nimsuggest")
+				self.statusView = None
+		sublime.set_timeout(clear, 5000)
 
 	def tryRestart(self):
 		"""
 		If the underlying process is stopped, restart it.
 		If it's already on, do nothing.
+		After a crash, nothing is done until the backoff delay is over.
 		"""
-		if not self.ready and not self.gettingReady:
+		if not self.ready and not self.gettingReady and time.time() >= self.restartAt:
 			self.setup(self.filePath)
 
+	def checkHealth(self):
+		"""
+		Called regularly by the pool.
+		A process that exited or stopped answering is stopped, it is started
+		again by tryRestart once the backoff is over. An idle process that
+		served too many requests or uses too much memory is replaced now.
+		"""
+		if not self.ready and not self.gettingReady:
+			if not self.stopped:
+				self.tryRestart()
+			return
+		self.memory = process_memory(self.process.pid)
+		request = self.inflight
+		if self.process.poll() != None:
+			self.fail("exited with code %d" % self.process.returncode)
+		elif request != None and request.deadline != None and time.time() > request.deadline + request.timeout:
+			# Still nothing long after the request timed out.
+			self.fail("not answering")
+		elif self.isIdle():
+			maxRequests = settings.get("nimplus.nimsuggest.max_requests", 0)
+			maxMemory = settings.get("nimplus.nimsuggest.max_memory_mb", 4096) * 1024 * 1024
+			if maxRequests > 0 and self.requestCount >= maxRequests:
+				self.recycle("served %d requests" % self.requestCount)
+			elif maxMemory > 0 and self.memory != None and self.memory > maxMemory:
+				self.recycle("uses %d MB" % (self.memory // (1024 * 1024)))
+
+	def fail(self, reason):
+		# The dispatcher sees the end of the output and does the rest.
+		print("NimPlus:", "nimsuggest of", self.projectName(), reason + ", stopping it")
+		stop_process(self.process)
+
+	def recycle(self, reason):
+		print("NimPlus:", "nimsuggest of", self.projectName(), reason + ", restarting it")
+		process = self.process
+		self.restarts += 1
+		# Replaced before being stopped: the old dispatcher leaves the queue alone.
+		self.setup(self.filePath)
+		stop_process(process)
+
 	def write(self, message):
 		try:
 			self.process.stdin.write(message.strip().encode("utf-8"))
@@ -133,107 +504,426 @@ class Nimsuggest:
 			return True
 		except:
 			return False # error probably because the process died.
-	def read(self):
-		return self.process.stdout.readline().decode("utf-8").strip()
 
 	def terminate(self):
-		self.process.stdin.close()
-		self.process.terminate()
-		self.process.wait(timeout=0.2)
+		self.stopped = True
+		stop_process(self.process)
 
-	def waitForOutput(self):
-		while self.output_queue.empty():
-			time.sleep(.01)
+	def isIdle(self):
+		with self.lock:
+			return self.inflight == None and len(self.pending) == 0 and not self.gettingReady
 
-	def requestDefinition(self, filename, line, col, callback):
+	def wakeUp(self):
+		try:
+			self.output_queue.put_nowait(WAKE_UP)
+		except Full:
+			pass # the dispatcher has output to read, it is not sleeping.
+
+	def submit(self, request):
+		"""
+		Queue a request. Its onResponse callback will be called with
+		the lines of the response, or with an empty list if the process died
+		or if the response did not come before the timeout of the request.
+		"""
+		dropped = []
+		with self.lock:
+			if request.key != None:
+				for old in self.pending:
+					if old.key == request.key:
+						old.dropped = True
+						dropped.append(old)
+				for old in dropped:
+					self.pending.remove(old)
+			self.pending.append(request)
+			while len(self.pending) > max_pending:
+				# Never the startup probe: its answer marks the process as ready.
+				oldest = next(old for old in self.pending if old.command != "probe")
+				self.pending.remove(oldest)
+				dropped.append(oldest)
+			# The dispatcher needs to know when the query is due.
+			self.wakeUp()
+		for old in dropped:
+			old.answer([])
+		self.sendNext()
+
+	def nextDueTime(self):
+		with self.lock:
+			if self.inflight != None or len(self.pending) == 0:
+				return None
+			return self.pending[0].notBefore
+
+	def sendNext(self):
+		failed = []
+		dropped = []
+		with self.lock:
+			while self.inflight == None and len(self.pending) > 0:
+				request = self.pending[0]
+				if request.stale(): # nobody wants the answer anymore
+					self.pending.popleft()
+					dropped.append(request)
+					continue
+				if request.notBefore > time.time():
+					break # debounced, the dispatcher will come back later.
+				self.pending.popleft()
+				# Set before writing, the answer can come back very fast.
+				self.inflight = request
+				request.writtenAt = time.time()
+				request.deadline = request.writtenAt + request.timeout
+				perf.record(request.command + ".queue", request.writtenAt - request.createdAt)
+				written = self.write(request.query)
+				perf.record(request.command + ".write", time.time() - request.writtenAt)
+				self.requestCount += 1
+				if not written: # process died, nothing will answer.
+					self.inflight = None
+					self.ready = False
+					failed.append(request)
+					failed.extend(self.pending)
+					self.pending.clear()
+				else: # the dispatcher needs to know the new deadline.
+					self.wakeUp()
+		for request in failed + dropped:
+			request.answer([])
+
+	def dispatchResponses(self, process, output_queue):
+		while True:
+			request = self.inflight
+			timeout = None # nothing to wait for, sleep until something happens.
+			if request != None and not request.answered:
+				timeout = max(request.deadline - time.time(), 0)
+			dueTime = self.nextDueTime()
+			if dueTime != None:
+				timeout = max(dueTime - time.time(), 0)
+			try:
+				item = output_queue.get(timeout=timeout)
+			except Empty:
+				if request != None and request is self.inflight and time.time() >= request.deadline:
+					self.expire(request)
+				self.sendNext()
+				continue
+			if item is None: # process exited
+				break
+			if process is not self.process:
+				# Replaced: let the reader of the old process finish.
+				while item is not None:
+					item = output_queue.get()
+				break
+			if item is not WAKE_UP:
+				for line in item:
+					self.handleLine(line)
+			else:
+				self.sendNext()
+		failed = []
+		with self.lock:
+			if process is not self.process:
+				return # restarted, the requests belong to the new process.
+			if self.inflight != None:
+				failed.append(self.inflight)
+			failed.extend(self.pending)
+			self.inflight = None
+			self.pending.clear()
+		for request in failed:
+			request.answer([])
+		# After the answers: the startup probe marks the process as ready.
+		self.ready = False
+		self.gettingReady = False
+		if not self.stopped:
+			self.failures += 1
+			self.restarts += 1
+			backoff = min(restart_backoff * 2 ** (self.failures - 1), max_restart_backoff)
+			self.restartAt = time.time() + backoff
+			print("NimPlus:", "nimsuggest of", self.projectName(), "stopped, restarting it in %ds" % backoff)
+
+	def expire(self, request):
+		"""
+		The request took too long. The caller gets an empty answer
+		but the request stays in flight: its response still has to be read
+		before the next one.
+		"""
+		print("NimPlus:","nimsuggest timed out on:", request.query)
+		perf.record(request.command + ".timeout", time.time() - request.writtenAt)
+		request.answer([])
+
+	def handleLine(self, raw):
+		"""
+		Responses look like this:
+		> sug\t...\n
+		sug\t...\n
+		\n
+		The "> " prompt is written before every query is read and an empty
+		line ends the response. Anything outside of a response is ignored.
+		"""
+		request = self.inflight
+		if request == None:
+			return
+		if request.firstLineAt == None:
+			request.firstLineAt = time.time()
+		line = raw.decode("utf-8", "replace").rstrip("\r")
+		while line.startswith(">"):
+			line = line[1:].lstrip(" ")
+			request.started = True
+		if len(line.strip()) == 0:
+			if request.started:
+				self.completeInflight()
+			return
+		if "\t" in line:
+			request.started = True
+			request.lines.append(line)
+			if request.onLine != None and not request.answered:
+				try:
+					request.onLine(line)
+				except Exception as err:
+					print("NimPlus:","Unexpected error:", sys.exc_info()[0])
+					print(err)
+
+	def completeInflight(self):
+		with self.lock:
+			request = self.inflight
+			self.inflight = None
+		now = time.time()
+		perf.record(request.command + ".first_byte", request.firstLineAt - request.writtenAt)
+		perf.record(request.command + ".last_byte", now - request.writtenAt)
+		if request.command != "probe":
+			self.failures = 0 # it works again
+		# Let nimsuggest work on the next query while we process this one.
+		self.sendNext()
+		if request.command == "probe" and request.answered:
+			# After the startup timeout, but the project is compiled now.
+			request.ok = True
+			self.onReady(request)
+			return
+		if request.stale(): # arrived too late, the view changed.
+			request.answer([])
+		else:
+			request.answer(request.lines, ok = True)
+
+	def prime(self, filename):
+		"""
+		Ask something cheap about a file, so that nimsuggest has it
+		compiled before the first real request about it.
+		"""
+		if filename in self.primed:
+			return
+		self.primed.add(filename)
+		request = NimsuggestRequest("def " + format_location(filename, 0, 0), lambda lines: None, key = ("prime", filename))
+		request.command = "prime"
+		self.submit(request)
+
+	def requestDefinition(self, filename, line, col, callback, dirtyFile = None, key = None, isStale = None):
 		"""
 		Request symbol definition. Callback will be called with
 		an "Definition" struct
 		"""
-		def processResponse():
-			self.waitForOutput()
+		def onResponse(lines):
+			start = time.time()
 			try:
-				data = []
-				while not self.output_queue.empty(): # flush read.
-					tmp = self.output_queue.get(block=False,timeout=1)
-					decoded = tmp.decode("utf-8")
-					if len(decoded.strip()) == 0: continue
-					data = decoded.split("\t")
-					
-					if len(data) == 9:
-						break
-				if len(data) == 9:
-					sd = SymbolDefinition()
-					sd.kind = data[1]
-					sd.fullname= data[2]
-					sd.symbolType = data[3]
-					sd.filename = data[4]
-					sd.line = int(data[5])
-					sd.col = int(data[6])
-					sd.docstring = data[7]
-					sd.raw = data
-					callback(sd)
+				sd = parse_definition(lines)
 			except Exception as err:
 				print("NimPlus:","Unexpected error:", sys.exc_info()[0])
 				print(err)
-				callback(None)
-		# line are 1-indexed for nim.
-		query = "def \"" + filename + "\":" + str(line+1) + ":" + str(col)
-		self.flush_queue(0.0)
-		res = self.write(query)
-		if not res: # process died
-			self.ready = False
-			callback(None)
-			return
-		Thread(target=processResponse).start()
+				sd = None
+			perf.record("def.parse", time.time() - start)
+			callback(sd)
+		query = "def " + format_location(filename, line, col, dirtyFile)
+		self.submit(NimsuggestRequest(query, onResponse, key = key, isStale = isStale))
 
-	def requestSuggestion(self, filename, line, col, callback):
+	def requestSuggestion(self, filename, line, col, callback, dirtyFile = None, key = None, isStale = None):
 		"""
 		Request suggestions from nimsuggest. Return proposed
 		suggestions by calling callback with as an argument an
-		array of suggestions.
+		array of Suggestion.
 		Note that no matter what, at some point, callback
 		will be called. And only once!
 		"""
-		def processResponse():
-			# Wait for response ...
-			self.waitForOutput()
+		def onResponse(lines):
+			start = time.time()
 			try:
+				suggestions = parse_suggestions(lines)
+			except Exception as err:
+				print("NimPlus:","Unexpected error:", sys.exc_info()[0])
+				print(err)
 				suggestions = []
-				while not self.output_queue.empty(): # flush read.
-					tmp = self.output_queue.get(block=False,timeout=1)
-					decoded = tmp.decode("utf-8")
-					if len(decoded.strip()) == 0: continue
-					data = decoded.split("\t")
-
-					if len(data) == 10:
-						suggestions.append(data)
-					if len(suggestions) > 1000:
-						break # no need for tones of suggestions.
-				while not self.output_queue.empty():
-					self.output_queue.get(block=False,timeout=1)
-				
-				callback(suggestions)
+			perf.record("sug.parse", time.time() - start)
+			callback(suggestions)
+		query = "sug " + format_location(filename, line, col, dirtyFile)
+		debounce = settings.get("nimplus.nimsuggest.debounce_ms", 40) / 1000.0
+		self.submit(NimsuggestRequest(query, onResponse, key = key, isStale = isStale, debounce = debounce))
+
+	def requestCheck(self, filename, callback, key = None):
+		"""
+		Check a file for errors with the graph nimsuggest already has in memory.
+		callback is called with a list of messages (see parse_check_results)
+		or with None if nimsuggest could not answer. It is not called when
+		a newer check with the same key replaces this one.
+		"""
+		def onResponse(lines):
+			if request.dropped:
+				return
+			if not request.ok:
+				callback(None)
 				return
+			start = time.time()
+			try:
+				messages = parse_check_results(lines)
 			except Exception as err:
 				print("NimPlus:","Unexpected error:", sys.exc_info()[0])
 				print(err)
-				callback([])
+				messages = None
+			perf.record("chk.parse", time.time() - start)
+			callback(messages)
+		query = "chk " + format_location(filename, 0, 0)
+		request = NimsuggestRequest(query, onResponse, key = key)
+		self.submit(request)
 
-		# lines are 1-indexed for nimsuggest.
-		query = "sug \"" + filename + "\":" + str(line+1) + ":" + str(col)
-		self.flush_queue(0.0)
-		res = self.write(query)
-		if not res:
-			self.ready = False
-			callback([])
-			return
-		t = Thread(target=processResponse)
-		t.daemon = True
-		t.start()
+	def listUsages(self, filename, line, col, onUsage, onDone, dirtyFile = None, limit = None):
+		"""
+		Find where the symbol at this position is used (the use command).
+		onUsage is called with a SymbolDefinition for each place as soon as
+		nimsuggest prints it, the definition first. After limit places, the
+		other ones are only counted.
+		onDone is called at the end with the number of places found, or with
+		None if nimsuggest did not answer.
+		"""
+		found = [0]
+		def onLine(line):
+			usage = parse_symbol(line)
+			if usage == None:
+				return
+			found[0] += 1
+			if limit == None or found[0] <= limit:
+				onUsage(usage)
+		def onResponse(lines):
+			onDone(found[0] if request.ok else None)
+		query = "use " + format_location(filename, line, col, dirtyFile)
+		request = NimsuggestRequest(query, onResponse, onLine = onLine)
+		self.submit(request)
 
-	def listUsages(self, filename, line, col):
-		pass
-	def renameSymbol(self, filename, line, col, newName):
-		pass
+	def renameSymbol(self, filename, line, col, newName, callback, dirtyFile = None):
+		"""
+		Find the places to change to rename the symbol at this position.
+		callback is called with (old name, edits), edits being an OrderedDict of
+		filename -> list of (line, col, newName), line starting at 1 and col at 0.
+		callback gets None instead if nimsuggest did not answer.
+		"""
+		usages = []
+		def onDone(count):
+			if count == None:
+				callback(None)
+				return
+			edits = OrderedDict()
+			for usage in usages:
+				edit = (usage.line, usage.col, newName)
+				places = edits.setdefault(usage.filename, [])
+				if edit not in places:
+					places.append(edit)
+			oldName = usages[0].shortName if len(usages) > 0 else None
+			callback((oldName, edits))
+		self.listUsages(filename, line, col, usages.append, onDone, dirtyFile)
+
+
+class NimsuggestPool:
+	"""
+	Keeps one nimsuggest instance per project so that every project
+	has a warm compiler graph (see find_project_root for what a project is).
+	When the pool is full, the least recently used idle instance is terminated.
+	A supervisor thread checks the health of the instances every few seconds.
+	"""
+	def __init__(self, maxSize = 3):
+		self.maxSize = maxSize
+		self.instances = OrderedDict() # project root -> Nimsuggest
+		self.lock = Lock()
+		self.supervisor = None
+		self.stopping = Event()
+
+	def supervise(self):
+		while not self.stopping.wait(supervise_interval):
+			with self.lock:
+				engines = list(self.instances.values())
+			for engine in engines:
+				try:
+					engine.checkHealth()
+				except Exception as err:
+					print("NimPlus:","Unexpected error:", sys.exc_info()[0])
+					print(err)
+
+	def get(self, filePath):
+		"""
+		Return the nimsuggest instance of the project of filePath,
+		starting it if needed.
+		"""
+		root = find_project_root(filePath)
+		with self.lock:
+			engine = self.instances.get(root)
+			if engine == None:
+				engine = Nimsuggest(filePath, root)
+				self.instances[root] = engine
+				self.evict()
+			else:
+				self.instances.move_to_end(root)
+			if self.supervisor == None:
+				self.supervisor = Thread(target=self.supervise)
+				self.supervisor.daemon = True
+				self.supervisor.start()
+		engine.tryRestart()
+		return engine
+
+	def prewarm(self, filePath, limit):
+		"""
+		Start the nimsuggest of the project of filePath if less than limit
+		instances are starting, and prime it on filePath.
+		A directory inside the root of a pooled instance does not get its own.
+		"""
+		root = find_project_root(filePath)
+		with self.lock:
+			if root not in self.instances:
+				if any(root.startswith(pooled + os.sep) for pooled in self.instances):
+					return
+				starting = sum(1 for engine in self.instances.values() if engine.gettingReady)
+				if starting >= limit:
+					return
+		self.get(filePath).prime(filePath)
+
+	def evict(self):
+		# Oldest first. Busy instances are kept even if the pool is too big,
+		# they will be evicted on a later call.
+		for root in list(self.instances.keys()):
+			if len(self.instances) <= max(self.maxSize, 1):
+				break
+			engine = self.instances[root]
+			if not engine.isIdle():
+				continue
+			del self.instances[root]
+			try:
+				engine.terminate()
+			except:
+				pass
+
+	def stats(self):
+		with self.lock:
+			engines = list(self.instances.items())
+		stats = OrderedDict()
+		for root, engine in engines:
+			if engine.ready:
+				state = "ready in %.1fs" % engine.timeToReady
+			elif engine.gettingReady:
+				state = "starting"
+			else:
+				state = "stopped"
+			if engine.memory != None:
+				state += ", %d MB" % (engine.memory // (1024 * 1024))
+			state += ", %d requests, %d restarts" % (engine.requestCount, engine.restarts)
+			stats[root] = state
+		return stats
+
+	def logs(self):
+		with self.lock:
+			return OrderedDict((root, list(engine.log)) for root, engine in self.instances.items())
 
+	def terminateAll(self):
+		self.stopping.set()
+		with self.lock:
+			for engine in self.instances.values():
+				try:
+					engine.terminate()
+				except:
+					pass
+			self.instances.clear()
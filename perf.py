@@ -0,0 +1,88 @@
+"""
+
+Timings of the different steps of NimPlus (nimsuggest startup, queries,
+parsing, building the popups...), to find out what makes things slow.
+
+"""
+
+import json
+from collections import deque, OrderedDict
+from threading import Lock
+
+class Histogram:
+	"""
+	The last samples of a duration, in milliseconds.
+	"""
+	def __init__(self, size = 500):
+		self.samples = deque(maxlen = size)
+		self.count = 0
+
+	def add(self, ms):
+		self.samples.append(ms)
+		self.count += 1
+
+	def summary(self):
+		samples = sorted(self.samples)
+		n = len(samples)
+		def percentile(p):
+			return samples[min(n - 1, int(p * n))]
+		return OrderedDict([
+			("count", self.count),
+			("last", round(self.samples[-1], 2)),
+			("min", round(samples[0], 2)),
+			("p50", round(percentile(0.5), 2)),
+			("p90", round(percentile(0.9), 2)),
+			("p99", round(percentile(0.99), 2)),
+			("max", round(samples[-1], 2)),
+			("mean", round(sum(samples) / n, 2))
+		])
+
+histograms = OrderedDict() # name -> Histogram
+lock = Lock()
+
+def record(name, seconds):
+	"""
+	Add a duration to the histogram called name, for example "sug.first_byte".
+	"""
+	with lock:
+		histogram = histograms.get(name)
+		if histogram == None:
+			histogram = Histogram()
+			histograms[name] = histogram
+		histogram.add(seconds * 1000.0)
+
+def summaries():
+	with lock:
+		return OrderedDict((name, histograms[name].summary()) for name in sorted(histograms.keys()))
+
+def clear():
+	with lock:
+		histograms.clear()
+
+def format_report(extra = None):
+	"""
+	Text table of all the timings in milliseconds.
+	extra is a dictionary of other counters to show at the end.
+	"""
+	columns = ["count", "last", "min", "p50", "p90", "p99", "max", "mean"]
+	rows = summaries()
+	width = max([len(name) for name in rows] + [10])
+	lines = ["NimPlus timings (ms)", ""]
+	lines.append("%-*s" % (width, "step") + "".join("%10s" % c for c in columns))
+	for name, summary in rows.items():
+		lines.append("%-*s" % (width, name) + "".join("%10s" % summary[c] for c in columns))
+	if len(rows) == 0:
+		lines.append("Nothing measured yet.")
+	if extra != None:
+		for title, values in extra.items():
+			lines.append("")
+			lines.append(title)
+			for key, value in values.items():
+				lines.append("  %s: %s" % (key, value))
+	return "\n".join(lines) + "\n"
+
+def export_json(extra = None):
+	data = OrderedDict([("timings", summaries())])
+	if extra != None:
+		data.update(extra)
+	return json.dumps(data, indent = 4)
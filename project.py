@@ -0,0 +1,84 @@
+"""
+
+Finding the root directory of the project a file belongs to.
+
+"""
+
+import os
+from threading import Lock
+
+# directory -> (mtime, has a .nimble file, has a nim.cfg or config.nims)
+# Adding or removing a file changes the mtime of its directory,
+# so a cached entry is valid as long as the mtime is the same.
+directory_markers = {}
+lock = Lock()
+
+def markers_of(directory):
+	try:
+		mtime = os.stat(directory).st_mtime
+	except OSError:
+		return False, False
+	with lock:
+		cached = directory_markers.get(directory)
+	if cached != None and cached[0] == mtime:
+		return cached[1], cached[2]
+	try:
+		names = os.listdir(directory)
+	except OSError:
+		names = []
+	has_nimble = any(x.endswith(".nimble") and os.path.isfile(os.path.join(directory,x)) for x in names)
+	has_config = "nim.cfg" in names or "config.nims" in names
+	with lock:
+		directory_markers[directory] = (mtime, has_nimble, has_config)
+	return has_nimble, has_config
+
+def find_roots(path):
+	"""
+	Move up the path and return the closest directory with a .nimble file
+	and the closest directory with a nim.cfg or config.nims (None if not found).
+	"""
+	p = os.path.abspath(path)
+	if not os.path.isdir(p):
+		p = os.path.dirname(p)
+	nimble_root = None
+	config_root = None
+	for i in range(100):
+		has_nimble, has_config = markers_of(p)
+		if has_config and config_root == None:
+			config_root = p
+		if has_nimble:
+			nimble_root = p
+			break
+		if p == os.path.dirname(p):
+			break
+		p = os.path.dirname(p)
+	return nimble_root, config_root
+
+def find_nimble_root(path):
+	"""
+	Directory of the .nimble file of the project, None if the file
+	is not part of a nimble project.
+	"""
+	return find_roots(path)[0]
+
+def has_project_root(path):
+	"""
+	True if the file is in a nimble project or under a nim.cfg or config.nims.
+	"""
+	nimble_root, config_root = find_roots(path)
+	return nimble_root != None or config_root != None
+
+def find_project_root(path):
+	"""
+	The nimble root of the file. Without a .nimble file, the closest directory
+	with a nim.cfg or config.nims, and if there is none, the directory of the file.
+	"""
+	nimble_root, config_root = find_roots(path)
+	if nimble_root != None:
+		return nimble_root
+	if config_root != None:
+		return config_root
+	p = os.path.abspath(path)
+	if os.path.isdir(p):
+		return p
+	return os.path.dirname(p)
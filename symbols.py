@@ -0,0 +1,252 @@
+"""
+
+Index of the symbols (procs, types, constants...) declared in the .nim files
+of a project, for the "Go to symbol in project" command.
+The files are scanned with regular expressions: no compiler involved, and
+only the files that changed since the last scan are read again.
+The index is saved in the cache directory of Sublime between sessions.
+
+"""
+
+import os
+import re
+import json
+import hashlib
+from threading import Lock, Event
+
+import sublime
+
+# proc foo*[T](...), iterator `[]`(...), ...
+routine_format = re.compile(r"^(\s*)(proc|func|method|iterator|template|macro|converter)\s+(`[^`]+`|[A-Za-z_]\w*)")
+# type, const, let and var sections, or a single declaration on the same line.
+section_format = re.compile(r"^(type|const|let|var)\b\s*(.*)$")
+# Name* {.pragma.} = ... inside a section.
+declaration_format = re.compile(r"^(\s*)(`[^`]+`|[A-Za-z_]\w*)\*?\s*(\[[^\]]*\])?\s*(\{\..*?\.\})?\s*[:=]")
+
+section_kinds = {"type": "type", "const": "const", "let": "let", "var": "var"}
+
+skipped_directories = {"nimcache", "node_modules", "htmldocs", "testresults"}
+max_files = 5000
+max_directories = 2000
+# Seconds between a change of the index and its save.
+save_delay = 30
+
+def scan_symbols(filename):
+	"""
+	Top level declarations of a file as (name, kind, line, col) tuples,
+	line and col starting at 1.
+	"""
+	symbols = []
+	section = None # kind of the type/const/let/var section we are in
+	indent = None # of the declarations of the section, deeper lines are their body
+	with open(filename, encoding="utf-8", errors="replace") as f:
+		for number, line in enumerate(f, 1):
+			if len(line.strip()) == 0 or line.lstrip().startswith("#"):
+				continue
+			match = routine_format.match(line)
+			if match != None:
+				section = None
+				symbols.append((match.group(3), match.group(2), number, len(match.group(1)) + 1))
+				continue
+			if not line[0].isspace():
+				section = None
+				match = section_format.match(line)
+				if match == None:
+					continue
+				section = section_kinds[match.group(1)]
+				indent = None
+				rest = match.group(2)
+				match = declaration_format.match(rest)
+				if match != None: # type Foo = object
+					col = len(line) - len(rest) + 1
+					symbols.append((match.group(2), section, number, col))
+					section = None
+				continue
+			if section != None:
+				match = declaration_format.match(line)
+				if match == None:
+					continue
+				if indent == None:
+					indent = len(match.group(1))
+				if len(match.group(1)) == indent:
+					symbols.append((match.group(2), section, number, indent + 1))
+	return symbols
+
+def nim_files(root):
+	# Limited in files and in directories: a root that is not really a
+	# project (a home directory...) is not walked entirely.
+	files = []
+	for count, (directory, directories, filenames) in enumerate(os.walk(root)):
+		if count >= max_directories:
+			break
+		directories[:] = [
+			d for d in directories
+			if not d.startswith(".") and d not in skipped_directories
+		]
+		for name in filenames:
+			if name.endswith(".nim"):
+				files.append(os.path.join(directory, name))
+				if len(files) >= max_files:
+					return files
+	return files
+
+class SymbolIndex:
+	"""
+	Symbols of every .nim file of a project.
+	files: filename -> (mtime, list of (name, kind, line, col))
+	"""
+	def __init__(self, root):
+		self.root = root
+		self.files = {}
+		self.lock = Lock()
+		self.updating = Lock() # one full update at a time
+		self.loaded = False # read from the disk and brought up to date
+		self.built = Event() # set once loaded
+		self.building = False # a build was started and is not over
+		self.changed = False # changes not saved yet
+
+	def cachePath(self):
+		digest = hashlib.sha1(self.root.encode("utf-8")).hexdigest()
+		return os.path.join(sublime.cache_path(), "NimPlus", "symbols", digest + ".json")
+
+	def load(self):
+		try:
+			with open(self.cachePath(), encoding="utf-8") as f:
+				data = json.load(f)
+		except (OSError, ValueError):
+			return
+		if data.get("root") != self.root:
+			return
+		with self.lock:
+			for filename, (mtime, symbols) in data["files"].items():
+				self.files[filename] = (mtime, [tuple(s) for s in symbols])
+
+	def save(self):
+		with self.lock:
+			data = {"root": self.root, "files": dict(self.files)}
+		path = self.cachePath()
+		try:
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			with open(path + ".tmp", "w", encoding="utf-8") as f:
+				json.dump(data, f)
+			os.replace(path + ".tmp", path)
+		except OSError as err:
+			print("NimPlus:", "could not save the symbol index:", err)
+
+	def updateFile(self, filename):
+		"""
+		Scan the file again if it changed. Returns True if it did.
+		"""
+		try:
+			mtime = os.stat(filename).st_mtime
+		except OSError:
+			with self.lock:
+				return self.files.pop(filename, None) != None
+		with self.lock:
+			cached = self.files.get(filename)
+		if cached != None and cached[0] == mtime:
+			return False
+		try:
+			symbols = scan_symbols(filename)
+		except OSError:
+			symbols = []
+		with self.lock:
+			self.files[filename] = (mtime, symbols)
+		return True
+
+	def update(self):
+		"""
+		Bring the whole index up to date: new, changed and removed files.
+		"""
+		with self.updating:
+			if not self.loaded:
+				self.load()
+			filenames = nim_files(self.root)
+			changed = False
+			for filename in filenames:
+				changed = self.updateFile(filename) or changed
+			existing = set(filenames)
+			with self.lock:
+				for filename in list(self.files.keys()):
+					if filename not in existing:
+						del self.files[filename]
+						changed = True
+			self.loaded = True
+			self.built.set()
+		if changed:
+			self.save()
+
+	def startBuild(self):
+		"""
+		Called before build, the first time the index is needed.
+		Returns False if the index is already loaded or being built:
+		there is nothing to do, built is set once it is ready.
+		"""
+		with self.lock:
+			if self.loaded or self.building:
+				return False
+			self.building = True
+			return True
+
+	def build(self):
+		"""
+		Load and update the index, after startBuild.
+		"""
+		try:
+			self.update()
+		finally:
+			self.cancelBuild()
+
+	def cancelBuild(self):
+		with self.lock:
+			self.building = False
+
+	def saveLater(self):
+		"""
+		Save the index in a while. A save writes the whole index: the
+		changes made until then are written with this one.
+		"""
+		with self.lock:
+			if self.changed:
+				return
+			self.changed = True
+		sublime.set_timeout_async(self.saveChanges, int(save_delay * 1000))
+
+	def saveChanges(self):
+		with self.lock:
+			if not self.changed:
+				return
+			self.changed = False
+		self.save()
+
+	def all(self):
+		"""
+		Every symbol as (name, kind, filename, line, col), sorted by name.
+		"""
+		with self.lock:
+			symbols = [
+				(name, kind, filename, line, col)
+				for filename, (mtime, found) in self.files.items()
+				for name, kind, line, col in found
+			]
+		symbols.sort(key=lambda s: (s[0].lower(), s[2], s[3]))
+		return symbols
+
+# project root -> SymbolIndex
+symbol_indexes = {}
+indexes_lock = Lock()
+
+def symbol_index_of(root):
+	with indexes_lock:
+		index = symbol_indexes.get(root)
+		if index == None:
+			index = SymbolIndex(root)
+			symbol_indexes[root] = index
+		return index
+
+def save_symbol_indexes():
+	# The changes waiting for saveLater.
+	with indexes_lock:
+		indexes = list(symbol_indexes.values())
+	for index in indexes:
+		index.saveChanges()
@@ -0,0 +1,76 @@
+"""
+
+All the background work of NimPlus runs on one small pool of threads
+instead of starting a new thread for every task.
+
+"""
+
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+class BoundedExecutor:
+	"""
+	Thread pool with a limit on the number of waiting tasks.
+	When too many tasks are waiting, new ones are refused instead
+	of piling up behind a stuck process.
+	"""
+	def __init__(self, maxWorkers = 8, maxQueued = 64):
+		self.executor = ThreadPoolExecutor(max_workers = maxWorkers)
+		self.maxWorkers = maxWorkers
+		self.maxQueued = maxQueued
+		self.lock = Lock()
+		self.active = 0
+		self.queued = 0
+		self.rejected = 0
+
+	def submit(self, fn, *args):
+		"""
+		Run fn(*args) on a worker thread.
+		Returns a Future, or None if the task was refused.
+		"""
+		with self.lock:
+			if self.queued >= self.maxQueued:
+				self.rejected += 1
+				print("NimPlus:","Too many background tasks, dropping", fn)
+				return None
+			self.queued += 1
+
+		def run():
+			with self.lock:
+				self.queued -= 1
+				self.active += 1
+			try:
+				return fn(*args)
+			except Exception as err:
+				print("NimPlus:","Unexpected error:", sys.exc_info()[0])
+				print(err)
+			finally:
+				with self.lock:
+					self.active -= 1
+
+		try:
+			return self.executor.submit(run)
+		except RuntimeError: # shut down, the plugin is being unloaded.
+			with self.lock:
+				self.queued -= 1
+			return None
+
+	def stats(self):
+		with self.lock:
+			return {
+				"workers": self.maxWorkers,
+				"active": self.active,
+				"queued": self.queued,
+				"rejected": self.rejected
+			}
+
+	def shutdown(self):
+		self.executor.shutdown(wait = False)
+
+executor = BoundedExecutor()
+
+def plugin_unloaded():
+	# Sublime calls this when this file is unloaded or reloaded, not when
+	# the files using the executor are: they get it as worker.executor.
+	executor.shutdown()